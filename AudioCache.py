@@ -0,0 +1,174 @@
+import os
+import json
+import hashlib
+import numpy as np
+import soundfile as sf
+import soxr
+
+# Amount of bytes hashed from both the start and the end of the audio file to identify it
+HASHED_BYTES = 1 << 20
+
+# Identifies a file by hashing only its start and end, along with its size and modification time,
+# which keeps checking the caches fast even for multi-hour recordings or large models
+def get_file_key(path):
+    stat = os.stat(path)
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as file:
+        file_hash.update(file.read(HASHED_BYTES))
+        if stat.st_size > HASHED_BYTES:
+            file.seek(max(HASHED_BYTES, stat.st_size - HASHED_BYTES))
+            file_hash.update(file.read(HASHED_BYTES))
+    return {
+        "hash": file_hash.hexdigest(),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+# Identifies the decoded audio of a file
+def get_audio_key(audio_path, sample_rate):
+    return {
+        "audio": os.path.abspath(audio_path),
+        **get_file_key(audio_path),
+        "sample_rate": sample_rate,
+    }
+
+def get_cache_paths(directory):
+    return (os.path.join(directory, "AudioCache.npy"), os.path.join(directory, "AudioCache.json"))
+
+# Sample rate the audio file is decoded at, which is the rate of the file itself when the given one is 0
+def resolve_sample_rate(audio_path, sample_rate):
+    return sample_rate or sf.info(audio_path).samplerate
+
+# Amount of samples librosa.load gives for the file when loaded at the sample rate
+def get_decoded_length(audio_path, sample_rate):
+    info = sf.info(audio_path)
+    if info.samplerate == sample_rate:
+        return info.frames
+    return int(np.ceil(info.frames * (float(sample_rate) / info.samplerate)))
+
+# Decodes the whole audio file as mono float32 samples at the sample rate, the same as librosa.load. Files already at that
+# rate are read with soundfile alone, and librosa, which takes seconds to import, is only imported to resample the others
+def load_audio(audio_path, sample_rate):
+    with sf.SoundFile(audio_path) as file:
+        if file.samplerate == sample_rate:
+            audio = file.read(dtype='float32', always_2d=True)
+            return (np.mean(audio, axis=1), sample_rate)
+    import librosa
+    return librosa.load(audio_path, sr=sample_rate)
+
+# Creates an empty memory-mapped cache to be filled with the decoded audio. The cache only becomes valid once
+# finish_audio_cache is called, so a run that stops half way never leaves behind a cache with missing audio
+def create_audio_cache(directory, length):
+    (data_path, key_path) = get_cache_paths(directory)
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    return np.lib.format.open_memmap(data_path, mode='w+', dtype=np.float32, shape=(length,))
+
+def finish_audio_cache(directory, cache, audio_path, sample_rate):
+    cache.flush()
+    (_, key_path) = get_cache_paths(directory)
+    with open(key_path, 'w') as file:
+        json.dump(get_audio_key(audio_path, sample_rate), file)
+
+# Saves audio that was already decoded in full
+def save_audio_cache(directory, y, audio_path, sample_rate):
+    cache = create_audio_cache(directory, len(y))
+    cache[:] = y
+    finish_audio_cache(directory, cache, audio_path, sample_rate)
+
+# Opens the cached audio as a read-only memory map, so only the parts that get used are read from disk.
+# Returns None if there is no cache, or if it was made from a different file or at a different sample rate
+def load_audio_cache(directory, audio_path, sample_rate):
+    (data_path, key_path) = get_cache_paths(directory)
+    if not os.path.exists(data_path) or not os.path.exists(key_path) or not os.path.exists(audio_path):
+        return None
+    with open(key_path, 'r') as file:
+        key = json.load(file)
+    if key != get_audio_key(audio_path, sample_rate):
+        return None
+    return np.load(data_path, mmap_mode='r')
+
+# Audio file accessed like the decoded audio array, but only reading the samples that are sliced out of it by
+# seeking into the file. Memory use then depends on the length of the slices rather than of the whole recording.
+# When the file has a different sample rate, only the read region is resampled, along with a margin on both
+# sides so the resampling filter has the same surroundings it would have when resampling the whole file
+class SeekableAudio:
+    def __init__(self, audio_path, sample_rate, margin=4096):
+        self.file = sf.SoundFile(audio_path)
+        self.sample_rate = sample_rate
+        self.margin = margin
+        self.length = get_decoded_length(audio_path, sample_rate)
+        # Smallest steps of the file and of the resampled audio that start at the same point in time
+        divisor = np.gcd(self.file.samplerate, sample_rate)
+        self.source_step = self.file.samplerate // divisor
+        self.target_step = sample_rate // divisor
+        self.last_read = (None, None)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        (start, stop, _) = index.indices(self.length)
+        stop = max(start, stop)
+        # Trimming slices every clip more than once, so the last read is kept
+        if self.last_read[0] != (start, stop):
+            self.last_read = ((start, stop), self.read(start, stop))
+        return self.last_read[1]
+
+    def read(self, start, stop):
+        if self.file.samplerate == self.sample_rate:
+            return self.read_source(start, stop)
+
+        # Region read from the file, widened by the margin and aligned to the common steps of both sample rates
+        first_step = max(0, (start - self.margin) // self.target_step)
+        last_step = (stop + self.margin) // self.target_step + 1
+        audio = self.read_source(first_step * self.source_step, last_step * self.source_step)
+        audio = soxr.resample(audio, self.file.samplerate, self.sample_rate, quality='soxr_hq')
+        offset = start - first_step * self.target_step
+        audio = audio[offset:offset + stop - start]
+        # The resampled audio is padded with silence up to the length librosa.load gives, same as at the end of the file
+        if len(audio) < stop - start:
+            audio = np.concatenate((audio, np.zeros(stop - start - len(audio), dtype=np.float32)))
+        return audio
+
+    # Reads the frames of the file as mono float32 samples, mixed down the same way as by librosa.load
+    def read_source(self, start, stop):
+        self.file.seek(min(start, self.file.frames))
+        audio = self.file.read(max(0, stop - start), dtype='float32', always_2d=True)
+        return np.mean(audio, axis=1)
+
+    def close(self):
+        self.file.close()
+
+def get_envelope_paths(directory):
+    return (os.path.join(directory, "Envelope.npy"), os.path.join(directory, "Envelope.json"))
+
+# Identifies the frame loudness of the decoded audio, which also depends on the frames it was computed over
+def get_envelope_key(audio_path, sample_rate, frame_length, hop_length):
+    return {
+        **get_audio_key(audio_path, sample_rate),
+        "frame_length": frame_length,
+        "hop_length": hop_length,
+    }
+
+# Saves the loudness (RMS) of every frame along with the amount of samples of the decoded audio, so the audio
+# can be segmented and trimmed again with different thresholds without being decoded
+def save_envelope(directory, rms, length, audio_path, sample_rate, frame_length, hop_length):
+    (data_path, key_path) = get_envelope_paths(directory)
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    np.save(data_path, rms.astype(np.float32))
+    with open(key_path, 'w') as file:
+        json.dump({"key": get_envelope_key(audio_path, sample_rate, frame_length, hop_length), "length": length}, file)
+
+# Opens the saved frame loudness as a read-only memory map, along with the amount of samples of the decoded audio.
+# Returns None if there is none, or if it was computed for a different file, sample rate or frames
+def load_envelope(directory, audio_path, sample_rate, frame_length, hop_length):
+    (data_path, key_path) = get_envelope_paths(directory)
+    if not os.path.exists(data_path) or not os.path.exists(key_path) or not os.path.exists(audio_path):
+        return None
+    with open(key_path, 'r') as file:
+        info = json.load(file)
+    if info["key"] != get_envelope_key(audio_path, sample_rate, frame_length, hop_length):
+        return None
+    return (np.load(data_path, mmap_mode='r'), info["length"])
@@ -1,12 +1,19 @@
-import librosa
 import numpy as np
 import soundfile as sf
+import soxr
 import os
 import sys
 import shutil
 import argparse
 import json
 
+from AudioCache import create_audio_cache, finish_audio_cache, save_audio_cache, load_audio_cache, get_decoded_length
+from AudioCache import resolve_sample_rate, load_audio
+from AudioCache import save_envelope, load_envelope, SeekableAudio
+from ClipExport import ClipExporter, EXPORT_FORMATS
+import Intervals
+import Instrumentation
+
 # Gets the path relative to either script or .exe location
 def get_dir():
     if getattr(sys, 'frozen', False):
@@ -23,73 +30,244 @@ def create_folder(path):
         shutil.rmtree(path)
         os.makedirs(path)
 
+# Reads the audio file block by block as mono float32 samples at the given sample rate. Blocks are mixed down
+# and resampled the same way librosa.load does it for the whole file, so the stream matches its output exactly
+def read_blocks(audio_path, sample_rate, block_size):
+    with sf.SoundFile(audio_path) as file:
+        resampler = None
+        length = file.frames
+        if file.samplerate != sample_rate:
+            resampler = soxr.ResampleStream(file.samplerate, sample_rate, 1, dtype='float32', quality='soxr_hq')
+            length = int(np.ceil(file.frames * (float(sample_rate) / file.samplerate)))
+
+        # Resampled streams are cut or padded with silence to the length librosa.load would give
+        streamed = 0
+        while True:
+            block = file.read(block_size, dtype='float32', always_2d=True)
+            last = file.tell() >= file.frames
+            block = np.mean(block, axis=1)
+            if resampler is not None:
+                block = resampler.resample_chunk(block, last=last)
+                block = block[:length - streamed]
+                if last and streamed + len(block) < length:
+                    block = np.concatenate((block, np.zeros(length - streamed - len(block), dtype=np.float32)))
+            streamed += len(block)
+            if len(block) > 0:
+                yield block
+            if last:
+                break
+
+# Reads already decoded audio block by block
+def get_array_blocks(y, block_size):
+    for start in range(0, len(y), block_size):
+        yield np.asarray(y[start:start + block_size])
+
+# Passes the blocks on while also copying them into the decoded audio cache
+def get_cached_blocks(blocks, cache):
+    offset = 0
+    for block in blocks:
+        cache[offset:offset + len(block)] = block[:len(cache) - offset]
+        offset += len(block)
+        yield block
+
+# Finds the frame loudness (RMS) of the whole audio while only holding a block of it in memory at a time.
+# Frames are centered and zero padded the same way as librosa.feature.rms, and frames overlapping two blocks
+# are computed once the following block arrives. Returns the frame loudness and the total amount of samples
+def get_streamed_rms(blocks, args):
+    padding = args.frame_length // 2
+    buffer = np.zeros(padding, dtype=np.float32)
+    rms = []
+    length = 0
+
+    for block in blocks:
+        length += len(block)
+        buffer = np.concatenate((buffer, block))
+        buffer = compute_buffered_frames(buffer, rms, args)
+
+    compute_buffered_frames(np.concatenate((buffer, np.zeros(padding, dtype=np.float32))), rms, args)
+    return (np.concatenate(rms), length)
+
+# Computes the loudness of all frames that fully fit into the buffer, and returns the part of the buffer
+# where the following frames start
+def compute_buffered_frames(buffer, rms, args):
+    if len(buffer) < args.frame_length:
+        return buffer
+    frame_count = 1 + (len(buffer) - args.frame_length) // args.hop_length
+    frames = buffer[:(frame_count - 1) * args.hop_length + args.frame_length]
+    rms.append(get_frame_rms(frames, args.frame_length, args.hop_length, center=False))
+    return buffer[frame_count * args.hop_length:]
+
+# Finds the loudness (RMS) of every frame, computed the same way as by librosa.feature.rms, which takes seconds to import.
+# Frames are laid out the same way as well, so the results match it to the bit
+def get_frame_rms(y, frame_length, hop_length, center=True):
+    if center:
+        y = np.pad(y, frame_length // 2, mode="constant")
+    frames = np.lib.stride_tricks.sliding_window_view(y, frame_length)[::hop_length].T
+    return np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=-2))
+
+# Finds the loudness of every frame in decibels relative to the loudest frame, the same as librosa.amplitude_to_db with ref=np.max
+def get_relative_db(rms, amin=1e-5):
+    magnitude = np.abs(rms)
+    reference = np.max(magnitude)
+    db = 10.0 * np.log10(np.maximum(amin ** 2, np.square(magnitude)))
+    db -= 10.0 * np.log10(np.maximum(amin ** 2, reference ** 2))
+    return db
+
+# Finds the non-silent intervals from the frame loudness, in samples. Same as librosa.effects.split, which
+# thresholds the loudness in decibels relative to the loudest frame
+def get_non_silent_intervals(rms, top_db, hop_length, length):
+    non_silent = get_relative_db(rms) > -top_db
+
+    # Finds points where frames switch between silent and non-silent
+    edges = [np.flatnonzero(np.diff(non_silent.astype(int))) + 1]
+    if non_silent[0]:
+        edges.insert(0, np.array([0]))
+    if non_silent[-1]:
+        edges.append(np.array([len(non_silent)]))
+
+    # Converts frames to samples, clipped to the signal duration
+    edges = np.concatenate(edges) * hop_length
+    edges = np.minimum(edges, length)
+    return Intervals.as_intervals(edges)
+
+# Yields the audio of the segments while streaming the audio file, holding only the audio of the segments
+# that haven't been fully read yet
+def get_streamed_segments(blocks, segments):
+    buffer = np.zeros(0, dtype=np.float32)
+    buffer_start = 0
+    next_segment = 0
+
+    for block in blocks:
+        buffer = np.concatenate((buffer, block))
+        buffer_end = buffer_start + len(buffer)
+
+        while next_segment < len(segments) and segments[next_segment][1] <= buffer_end:
+            start, end = segments[next_segment]
+            yield (next_segment, buffer[start - buffer_start:end - buffer_start])
+            next_segment += 1
+
+        # Audio before the start of the next segment is no longer needed
+        keep_from = segments[next_segment][0] if next_segment < len(segments) else buffer_end
+        keep_from = min(max(keep_from, buffer_start), buffer_end)
+        buffer = buffer[keep_from - buffer_start:]
+        buffer_start = keep_from
+
+# Yields the audio of every segment, streaming the file a second time only if the decoded audio isn't at hand
+def get_segment_audio(y, args, sr, segments):
+    if y is None:
+        yield from get_streamed_segments(read_blocks(args.audio, sr, args.block_size), segments)
+    else:
+        for i, (start, end) in enumerate(segments):
+            yield (i, y[start:end])
+
+def get_segment_filename(i):
+    return f"segment{i:04d}.wav"
+
+# Saves the timestamps of the audio segments
+def write_timestamps(directory, segments):
+    with open(os.path.join(directory, "Timestamps.txt"), 'w') as file:
+        for start, end in segments:
+            file.write(f"{start},{end}\n")
+
+# Finds the non-silent segments of the audio file, as an array of (start, end) samples. The silence is detected at the analysis rate,
+# or the sample rate if there is none. Returns the decoded audio at that rate, or None if it was streamed without being kept, along with
+# the rate and the segments, as well as their timestamps at the sample rate the clips are cut at
+def find_segments(args, directory):
+    audio_path = args.audio
+    cut_rate = resolve_sample_rate(audio_path, args.sample_rate)
+
+    with Instrumentation.stage("load"):
+        # The audio decoded by a former run is reused from the cache, as long as the file and sample rate stayed the same
+        sr = args.analysis_rate or cut_rate
+        y = load_audio_cache(directory, audio_path, sr) if args.audio_cache else None
+
+        # The frame loudness saved by a former run is reused, so segmenting again with different thresholds doesn't decode the audio.
+        # Without the decoded audio cache, the segments are then read straight from the file
+        envelope = load_envelope(directory, audio_path, sr, args.frame_length, args.hop_length) if args.envelope else None
+        if envelope is not None:
+            (rms, length) = envelope
+            if y is None:
+                y = SeekableAudio(audio_path, sr)
+
+        # Processing audiofile to get the frame loudness, either streamed or with the whole file loaded into memory
+        elif args.streaming:
+            if y is not None:
+                (rms, length) = get_streamed_rms(get_array_blocks(y, args.block_size), args)
+            elif args.audio_cache:
+                # The cache is filled while streaming and then used to cut the segments, so the file is only decoded once
+                cache = create_audio_cache(directory, get_decoded_length(audio_path, sr))
+                (rms, length) = get_streamed_rms(get_cached_blocks(read_blocks(audio_path, sr, args.block_size), cache), args)
+                if length == len(cache):
+                    finish_audio_cache(directory, cache, audio_path, sr)
+                    y = cache
+            else:
+                (rms, length) = get_streamed_rms(read_blocks(audio_path, sr, args.block_size), args)
+        else:
+            if y is None:
+                y, sr = load_audio(audio_path, sr)
+                if args.audio_cache:
+                    save_audio_cache(directory, y, audio_path, sr)
+            rms = get_frame_rms(y, args.frame_length, args.hop_length)
+            length = len(y)
+
+        if envelope is None and args.envelope:
+            save_envelope(directory, rms, length, audio_path, sr, args.frame_length, args.hop_length)
+
+    with Instrumentation.stage("split"):
+        # Filters for non_silent segments
+        non_silent = get_non_silent_intervals(rms, args.top_db, args.hop_length, length)
+
+        # Finds all silent segments as a reverse compliment of non_silent, and filters them for long_silent
+        silent = Intervals.complement(non_silent, length)
+        long_silent = Intervals.filter_length(silent, args.minimum_silent, sr)
+
+        # Finds longer non_silent segments by finding a reverse compliment of long_silent segments,
+        # and filters out too short audio segments
+        new_non_silent = Intervals.complement(long_silent, length)
+        filtered_non_silent = Intervals.filter_length(new_non_silent, args.minimum_non_silent, sr)
+
+        # Create proper segments for cutting up segments, used for both the segment audio and the timestamps
+        segments = Intervals.pad(filtered_non_silent, int(args.silent_buffer * sr * 0.2), int(args.silent_buffer * sr), length)
+
+        # Segments found at the analysis rate are mapped to the nearest samples of the rate the clips are cut at
+        timestamps = Intervals.rescale(segments, sr, cut_rate, get_decoded_length(audio_path, cut_rate))
+
+    Instrumentation.count("segments", len(segments))
+    return (y, sr, segments, timestamps)
+
 def main(args):
+    Instrumentation.start_run("AudioCutter")
     
     # Definitions for filepaths used in the script
-    directory = get_dir()
-    audio_path = args.audio
+    directory = args.workspace or get_dir()
     segment_directory =  os.path.join(directory, "Segments")
 
     create_folder(segment_directory)
 
-    # Processing audiofile to get stream and sample rate
-    y, sr = librosa.load(audio_path, sr = args.sample_rate)
-
-    # Filters for non_silent segments
-    non_silent = librosa.effects.split(y, top_db = args.top_db, frame_length = args.frame_length, hop_length = args.hop_length)
-
-    # Finds all silent segments as a reverse compliment of non_silent
-    total_duration = len(y) / sr
-    silent = []
-    for i in range(len(non_silent) + 1):
-        start = 0 if i == 0 else non_silent[i - 1][1]
-        end = total_duration if i == len(non_silent) else non_silent[i][0]
-        silent.append((start, end))
-
-    # Filters silent segments for long_silent
-    long_silent = [interval for interval in silent if (interval[1] - interval[0]) / sr >= args.minimum_silent]
-
-    # Finds longer non_silenet segments by finding a reverse compliment of long_silent segments
-    new_non_silent = []
-    for i in range(len(long_silent) + 1):
-        start = 0 if i == 0 else long_silent[i - 1][1]
-        end = total_duration if i == len(long_silent) else long_silent[i][0]
-        new_non_silent.append((start, end))
-
-    # Converts array to proper datatype
-    new_non_silent = np.array(new_non_silent, dtype=np.int32)
-
-    # Filters out too short audio segments
-    filtered_non_silent = [interval for interval in new_non_silent if (interval[1] - interval[0]) / sr >= args.minimum_non_silent]
-    filtered_non_silent = np.array(filtered_non_silent, dtype=np.int64)
-
-    # Create proper segments for cutting up segments
-    segments = []
-    for start, end in filtered_non_silent:
-        start -= int(args.silent_buffer * sr * 0.2)
-        start = max(start, 0)
-        end += int(args.silent_buffer * sr)
-        end = min(end, len(y))
-        segments.append(y[start:end])
-
-    # Saves the cut up audio segments
-    for i, segment in enumerate(segments):
-        sf.write(os.path.join(segment_directory, f"segment{i:04d}.wav"), segment, sr, format='wav', subtype = 'PCM_32')
-
-    # Saves the timestamps of the audio segments
-    with open(os.path.join(directory, "Timestamps.txt"), 'w') as file:
-        for start, end in filtered_non_silent:
-            start -= int(args.silent_buffer * sr * 0.2)
-            start = max(start, 0)
-            end += int(args.silent_buffer * sr)
-            end = min(end, len(y))
-            file.write(f"{start},{end}\n")
+    (y, sr, segments, timestamps) = find_segments(args, directory)
 
-if __name__ == "__main__":
+    # Saves the cut up audio segments, several at a time
+    with Instrumentation.stage("write segments"):
+        exporter = ClipExporter(segment_directory, args.export_format, args.export_workers, sr)
+        try:
+            for i, segment in get_segment_audio(y, args, sr, segments):
+                exporter.write(get_segment_filename(i), segment)
+        finally:
+            exporter.close()
+    print(exporter.stats())
+    Instrumentation.count("bytes_written", exporter.bytes)
+
+    write_timestamps(directory, timestamps)
+    Instrumentation.save_report(directory)
+
+# Arguments of the whole processor, saved into args.json for the later scripts to reuse. The audio and dialogue files
+# are only left optional for scripts that take them from elsewhere
+def get_argument_parser(require_files=True):
     parser = argparse.ArgumentParser(description="Script to cut up audio file by transcript")
 
-    parser.add_argument("--audio", required=True)
-    parser.add_argument("--dialogue", required=True)
+    parser.add_argument("--audio", required=require_files)
+    parser.add_argument("--dialogue", required=require_files)
+    parser.add_argument("--workspace", default=None)
     parser.add_argument("--top_db",type=int, default=40)
     parser.add_argument("--minimum_silent", type=float, default=0.5)
     parser.add_argument("--minimum_non_silent", type=float, default=0.2)
@@ -97,6 +275,15 @@ if __name__ == "__main__":
     parser.add_argument("--frame_length", type=int, default=2048)
     parser.add_argument("--hop_length", type=int, default=512)
     parser.add_argument("--sample_rate", type=int, default=48000)
+    parser.add_argument("--analysis_rate", type=int, default=0)
+    parser.add_argument("--streaming", type=int, default=0)
+    parser.add_argument("--block_size", type=int, default=1 << 20)
+    parser.add_argument("--audio_cache", type=int, default=1)
+    parser.add_argument("--export_format", choices=list(EXPORT_FORMATS), default="PCM_32")
+    parser.add_argument("--export_workers", type=int, default=4)
+    parser.add_argument("--extraction", choices=["memory", "seek"], default="memory")
+    parser.add_argument("--envelope", type=int, default=1)
+    parser.add_argument("--trim", choices=["samples", "envelope"], default="samples")
     parser.add_argument("--substring_threshold", type=int, default=0.724)
     parser.add_argument("--match_threshold_short", type=int, default=0.875)
     parser.add_argument("--match_threshold_long", type=float, default=0.775)
@@ -108,10 +295,22 @@ if __name__ == "__main__":
     parser.add_argument("--backtrack_limit", type=int, default=20)
     parser.add_argument("--forwardtrack_limit", type=int, default=20)
     parser.add_argument("--max_random_name_length", type=int, default=100)
+    parser.add_argument("--similarity_cache_size", type=int, default=1000000)
+    parser.add_argument("--lookup", choices=["window", "index"], default="window")
+    parser.add_argument("--lookup_candidates", type=int, default=10)
+    parser.add_argument("--matcher", choices=["greedy", "align"], default="greedy")
+    parser.add_argument("--align_max_merge", type=int, default=4)
 
+    return parser
+
+if __name__ == "__main__":
+    parser = get_argument_parser()
     args = parser.parse_args()
 
-    with open(os.path.join(get_dir(), "args.json"), 'w') as file:
+    # Working files are kept in the workspace, next to the script unless given
+    directory = args.workspace or get_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "args.json"), 'w') as file:
         json.dump(vars(args), file)
 
     main(args)
\ No newline at end of file
@@ -0,0 +1,223 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import AudioCutter
+import Transcriber
+import ClipMaker
+from TranscriptionCache import TranscriptionCache
+from AudioCache import get_audio_key
+import Instrumentation
+
+# Gets the path relative to either script or .exe location
+def get_dir():
+    if getattr(sys, 'frozen', False):
+        dir = os.path.dirname(sys.executable)
+    else:
+        dir = os.path.dirname(os.path.abspath(__file__))
+    return dir
+
+# Reads the sessions from the manifest, a JSON list of {"audio": ..., "dialogue": ...} objects. Every session is given
+# its own workspace in the output folder, named by its optional "name" or else by its audio file.
+# Relative paths are taken from the folder of the manifest
+def read_sessions(manifest_path, output_directory):
+    with open(manifest_path, 'r', encoding="utf-8") as file:
+        entries = json.load(file)
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_path))
+
+    sessions = []
+    names = set()
+    for entry in entries:
+        audio_path = os.path.join(manifest_directory, entry["audio"])
+        dialogue_path = os.path.join(manifest_directory, entry["dialogue"])
+        name = entry.get("name") or os.path.splitext(os.path.basename(audio_path))[0]
+        # Sessions of audio files sharing a name are numbered, so they don't share a workspace
+        unique_name = name
+        number = 2
+        while unique_name in names:
+            unique_name = f"{name}_{number}"
+            number += 1
+        names.add(unique_name)
+        sessions.append((unique_name, audio_path, dialogue_path, os.path.join(output_directory, unique_name)))
+    return sessions
+
+# Arguments of a single session, saved into its workspace the same way as by AudioCutter, so the separate
+# scripts can be rerun on it with --workspace
+def get_session_args(args, audio_path, dialogue_path, workspace):
+    session_args = argparse.Namespace(**vars(args))
+    session_args.audio = audio_path
+    session_args.dialogue = dialogue_path
+    session_args.workspace = workspace
+    session_args.mode = "clips"
+
+    os.makedirs(workspace, exist_ok=True)
+    with open(os.path.join(workspace, "args.json"), 'w') as file:
+        json.dump(vars(session_args), file)
+    return session_args
+
+# Arguments that change the segments cut out of a recording
+CUT_ARGS = ["top_db", "minimum_silent", "minimum_non_silent", "silent_buffer", "frame_length", "hop_length", "sample_rate",
+            "analysis_rate", "export_format"]
+
+# Identifies the segments of a recording by its audio file and the arguments it was cut with
+def get_cut_fingerprint(args):
+    return ClipMaker.get_stage_fingerprint(get_audio_key(args.audio, args.sample_rate), {name: getattr(args, name) for name in CUT_ARGS})
+
+# Stages run on the process pool, each within the workspace of its session. The cutting is skipped when the workspace holds
+# the segments a former batch finished cutting from the same audio with the same arguments, so their files stay the same
+# and the transcriptions journaled for them still apply. The record of the cut is only saved once all segments are written.
+# Returns whether the recording was cut
+def cut_session(args):
+    key_path = os.path.join(args.workspace, "SegmentsKey.json")
+    fingerprint = get_cut_fingerprint(args)
+    if os.path.exists(key_path) and os.path.exists(os.path.join(args.workspace, "Timestamps.txt")):
+        with open(key_path, 'r') as file:
+            if json.load(file) == fingerprint:
+                return False
+        os.remove(key_path)
+    AudioCutter.main(args)
+    with open(key_path, 'w') as file:
+        json.dump(fingerprint, file)
+    return True
+
+def match_session(args):
+    ClipMaker.main(args)
+
+def main(args):
+    Instrumentation.start_run("Batch")
+    output_directory = args.output or os.path.join(get_dir(), "Sessions")
+    sessions = read_sessions(args.manifest, output_directory)
+    session_args = [get_session_args(args, audio_path, dialogue_path, workspace) for _, audio_path, dialogue_path, workspace in sessions]
+    print(f"Processing {len(sessions)} sessions in {output_directory}")
+
+    # Worker processes of the model are started before the pool of the other stages, so they aren't forked while its threads
+    # are running. The pool itself starts its processes afresh, as they can't be safely forked once the model's are running
+    engine = Transcriber.get_engine(args, args.transcription_workers)
+    engine.start()
+    pool = ProcessPoolExecutor(max_workers=args.session_workers or os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+
+    errors = {}
+    files = {}
+    transcripts = {}
+    journals = {}
+    match_futures = {}
+
+    # A session is handed over to matching as soon as all of its segments are transcribed
+    def finish_transcription(k):
+        journals.pop(k).close()
+        with open(os.path.join(sessions[k][3], "Transcript.txt"), 'w', encoding="utf-8") as file:
+            for i in range(len(files[k])):
+                file.write(transcripts[k][i] + '\n')
+        match_futures[pool.submit(match_session, session_args[k])] = k
+
+    # Segments of all the sessions are transcribed by the one model, as (session, segment) items in the order their
+    # sessions finish being cut. Segments journaled by a former batch that didn't finish are skipped
+    def get_items():
+        segment_futures = {pool.submit(cut_session, session_args[k]): k for k in range(len(sessions))}
+        for future in as_completed(segment_futures):
+            k = segment_futures[future]
+            if future.exception() is not None:
+                errors[k] = future.exception()
+                print(f"{sessions[k][0]}: cutting failed, {errors[k]!r}")
+                continue
+
+            segment_directory = os.path.join(sessions[k][3], "Segments")
+            files[k] = sorted(os.listdir(segment_directory))
+            journals[k] = Transcriber.TranscriptJournal(sessions[k][3], engine)
+            transcripts[k] = journals[k].load(segment_directory, files[k], args.resume)
+            cut = "cut into" if future.result() else "kept the former cut of"
+            print(f"{sessions[k][0]}: {cut} {len(files[k])} segments, {len(transcripts[k])} already transcribed")
+            if len(transcripts[k]) == len(files[k]):
+                finish_transcription(k)
+                continue
+
+            for i, file in enumerate(files[k]):
+                if i not in transcripts[k]:
+                    yield ((k, i), Transcriber.load_segment(os.path.join(segment_directory, file)))
+
+    meter = Transcriber.ThroughputMeter(args.throughput_window)
+    transcribed = 0
+    from_cache = 0
+    def add_text(index, transcribed_text, from_model):
+        nonlocal transcribed, from_cache
+        (k, i) = index
+        transcripts[k][i] = transcribed_text
+        journals[k].add(i, transcribed_text)
+        transcribed += 1
+        progress = ""
+        if not from_model:
+            from_cache += 1
+        else:
+            meter.add()
+            # Only the segments of the sessions cut so far are known
+            remaining = sum(len(files[j]) - len(transcripts[j]) for j in journals)
+            progress = f" ({meter.rate():.2f} segments/s, ETA {meter.eta(remaining)})"
+        print(f"{sessions[k][0]}: segment {i + 1:04d}/{len(files[k]):04d}: \"{transcribed_text}\"{progress}")
+        if len(transcripts[k]) == len(files[k]):
+            finish_transcription(k)
+
+    cache = TranscriptionCache(output_directory, args.transcription_cache_size) if args.transcription_cache else None
+    start_time = time.perf_counter()
+    try:
+        with Instrumentation.stage("transcribe"):
+            Transcriber.transcribe_segments(get_items(), engine, cache, add_text)
+    finally:
+        engine.close()
+        for journal in journals.values():
+            journal.close()
+        if cache is not None:
+            cache.save()
+    elapsed = time.perf_counter() - start_time
+    # Only the segments transcribed by the model count towards the throughput, not the ones found in the cache
+    from_model = transcribed - from_cache
+    print(f"Cut and transcribed {from_model} segments in {elapsed:.1f}s, {from_model / max(elapsed, 1e-9):.2f} segments/s, "
+          f"{from_cache} taken from the cache")
+    if cache is not None:
+        print(cache.stats())
+
+    for future in as_completed(match_futures):
+        k = match_futures[future]
+        if future.exception() is not None:
+            errors[k] = future.exception()
+            print(f"{sessions[k][0]}: matching failed, {errors[k]!r}")
+        else:
+            print(f"{sessions[k][0]}: clips saved")
+    pool.shutdown()
+    Instrumentation.count("sessions_failed", len(errors))
+    Instrumentation.save_report(output_directory)
+
+    # Failed sessions don't stop the others, but are listed at the end
+    print(f"Finished {len(sessions) - len(errors)}/{len(sessions)} sessions in {time.perf_counter() - start_time:.1f}s")
+    for k in sorted(errors):
+        print(f"Failed: {sessions[k][0]}, {errors[k]!r}")
+    if errors:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    # All the arguments of AudioCutter are applied to every session, along with the options of the later stages
+    parser = AudioCutter.get_argument_parser(require_files=False)
+    parser.description = "Script to cut up, transcribe and match many audio files, each in its own workspace"
+    parser.add_argument("--manifest", required=True)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--transcription_workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--transcription_cache", type=int, default=1)
+    parser.add_argument("--transcription_cache_size", type=int, default=100000)
+    parser.add_argument("--resume", type=int, default=1)
+    parser.add_argument("--throughput_window", type=int, default=20)
+    parser.add_argument("--service", type=int, default=1)
+    parser.add_argument("--service_port", type=int, default=Transcriber.SERVICE_PORT)
+    parser.add_argument("--service_priority", type=int, default=0)
+    parser.add_argument("--use_similarity_matrix", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--session_workers", type=int, default=0)
+    parser.add_argument("--trace", type=int, choices=[0, 1, 2], default=0)
+
+    main(parser.parse_args())
@@ -0,0 +1,423 @@
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import multiprocessing
+import subprocess
+import numpy as np
+import soundfile as sf
+
+import AudioCutter
+import ClipMaker
+from AudioCache import SeekableAudio, load_audio
+from ClipExport import ClipExporter
+from Instrumentation import TraceLog, TRACE_OFF, get_peak_rss
+
+# Gets the path relative to either script or .exe location
+def get_dir():
+    if getattr(sys, 'frozen', False):
+        dir = os.path.dirname(sys.executable)
+    else:
+        dir = os.path.dirname(os.path.abspath(__file__))
+    return dir
+
+# Arguments of the processor with their default values, as AudioCutter would save them into args.json
+def get_default_args(**overrides):
+    args = AudioCutter.get_argument_parser().parse_args(["--audio", "", "--dialogue", ""])
+    args.mode = "clips"
+    args.use_similarity_matrix = 0
+    args.workers = 0
+    for name, value in overrides.items():
+        setattr(args, name, value)
+    return args
+
+# Generates a synthetic dialogue script out of random words. Lines are returned normalized, along with their ids
+def generate_script(line_count, rng):
+    vocabulary = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 9))) for _ in range(2000)]
+    lines = [" ".join(rng.choice(vocabulary) for _ in range(rng.randint(2, 30))) for _ in range(line_count)]
+    ids = [f"line_{i:05d}" for i in range(line_count)]
+    return (lines, ids, vocabulary)
+
+# Misspells a share of the characters of the text, the way a transcription might
+def add_typos(text, typo_rate, rng):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") if character != " " and rng.random() < typo_rate else character
+                   for character in text)
+
+# Generates the transcript of a synthetic recording of the script. Lines are read mostly in order, with retakes,
+# jumps back to repeat a few earlier lines, lines split over several segments, segments where no text was
+# transcribed and segments that don't belong to the script. Returns the transcript, the segment timestamps
+# and the script line every segment really belongs to, or None for segments that belong to no line
+def generate_transcript(lines, vocabulary, rng, sample_rate, retake_rate=0.1, repeat_rate=0.03, split_rate=0.1,
+                        miss_rate=0.05, noise_rate=0.05, typo_rate=0.03):
+    transcript = []
+    truth = []
+    lidx = 0
+    while lidx < len(lines):
+        roll = rng.random()
+        if roll < miss_rate:
+            transcript.append("")
+            truth.append(None)
+        elif roll < miss_rate + noise_rate:
+            transcript.append(" ".join(rng.choice(vocabulary) for _ in range(rng.randint(2, 6))))
+            truth.append(None)
+
+        words = add_typos(lines[lidx], typo_rate, rng).split()
+        if len(words) > 4 and rng.random() < split_rate:
+            split = rng.randint(1, len(words) - 1)
+            transcript += [" ".join(words[:split]), " ".join(words[split:])]
+            truth += [lidx, lidx]
+        else:
+            transcript.append(" ".join(words))
+            truth.append(lidx)
+
+        roll = rng.random()
+        if roll < repeat_rate:
+            lidx = max(0, lidx - rng.randint(1, 5))
+        elif roll >= repeat_rate + retake_rate:
+            lidx += 1
+
+    # Segments of one to three seconds, separated by one second of silence
+    timestamps = []
+    position = sample_rate
+    for _ in transcript:
+        length = rng.randint(sample_rate, 3 * sample_rate)
+        timestamps.append([position, position + length])
+        position += length + sample_rate
+    return (transcript, timestamps, truth)
+
+# Share of the matched clips that were given the id of the script line they really belong to
+def get_match_accuracy(final_timestamps, filenames, ids, timestamps, truth):
+    segment_by_start = {start: tidx for tidx, (start, _) in enumerate(timestamps)}
+    matched = 0
+    correct = 0
+    for (start, _), filename in zip(final_timestamps, filenames):
+        if filename.startswith("UNKNOWN") or filename.startswith("UNIDENTIFIED"):
+            continue
+        matched += 1
+        line = truth[segment_by_start[start]]
+        if line is not None and filename.startswith(ids[line] + "__"):
+            correct += 1
+    return correct / matched if matched else 0
+
+# Runs both matchers over synthetic sessions of every size, comparing their runtime and results
+def benchmark_matchers(options):
+    results = []
+    log = TraceLog(None, TRACE_OFF)
+    for size in options.sizes:
+        rng = random.Random(options.seed + size)
+        (lines, ids, vocabulary) = generate_script(size, rng)
+        (transcript, timestamps, truth) = generate_transcript(lines, vocabulary, rng, 48000)
+
+        for matcher in options.matchers:
+            args = get_default_args(matcher=matcher, lookup=options.lookup)
+            scores = ClipMaker.SimilarityCache(lines, transcript, args.similarity_cache_size)
+            index = ClipMaker.ScriptIndex(lines) if args.lookup == "index" else None
+            match_function = ClipMaker.match_transcript_aligned if matcher == "align" else ClipMaker.match_transcript
+
+            start_time = time.perf_counter()
+            (final_timestamps, filenames, id_dictionary) = match_function(lines, ids, transcript, timestamps, args, scores, index, log)
+            runtime = time.perf_counter() - start_time
+
+            result = {
+                "stage": "match",
+                "matcher": matcher,
+                "lookup": options.lookup,
+                "script_lines": len(lines),
+                "segments": len(transcript),
+                "seconds": runtime,
+                "similarity_calls": scores.misses,
+                "clips": len(filenames),
+                "unknown": sum(1 for filename in filenames if filename.startswith("UNKNOWN")),
+                "unidentified": sum(1 for filename in filenames if filename.startswith("UNIDENTIFIED")),
+                "not_found": sum(1 for id in ids if id not in id_dictionary),
+                "accuracy": get_match_accuracy(final_timestamps, filenames, ids, timestamps, truth),
+            }
+            results.append(result)
+            print(f"{matcher:>6} {len(lines):6d} lines {len(transcript):6d} segments: {runtime:8.3f}s, "
+                  f"{result['similarity_calls']} similarity calls, {result['unknown']} unknown, "
+                  f"{result['not_found']} not found, {result['accuracy']:.3f} accuracy")
+    return results
+
+# Fields identifying a benchmark result, so results of former runs can be compared to the ones with the same fields
+RESULT_FIELDS = ["stage", "script", "matcher", "lookup", "extraction", "streaming", "analysis_rate", "script_lines", "segments", "minutes"]
+
+# Writes the audio of a synthetic recording of the given length, with a burst of tone and noise for every segment.
+# Bursts are separated by at least 0.6 seconds of faint noise, which stays longer than the default --minimum_silent
+# after the loudness frames blur the edges of the bursts. The audio is written segment by segment, so hours of it
+# don't need to fit into memory
+def generate_audio(path, segment_count, minutes, sample_rate, rng):
+    slot = minutes * 60 / segment_count
+    if slot < 0.9:
+        raise ValueError(f"{segment_count} segments don't fit into {minutes} minutes, every segment needs at least 0.9 seconds")
+    noise = np.random.default_rng(rng.randint(0, 1 << 30))
+    fade = np.linspace(0, 1, int(0.01 * sample_rate), dtype=np.float32)
+
+    with sf.SoundFile(path, 'w', samplerate=sample_rate, channels=1, subtype='PCM_16') as file:
+        for _ in range(segment_count):
+            burst_seconds = rng.uniform(max(0.3, (slot - 0.6) / 2), min(slot - 0.6, 4))
+            burst_length = int(burst_seconds * sample_rate)
+            silence_length = int(slot * sample_rate) - burst_length
+            file.write(noise.normal(0, 1e-4, silence_length).astype(np.float32))
+
+            time_axis = np.arange(burst_length, dtype=np.float32) / sample_rate
+            burst = 0.3 * np.sin(2 * np.pi * rng.uniform(150, 1500) * time_axis) + noise.normal(0, 0.03, burst_length)
+            burst = burst.astype(np.float32)
+            fade_length = min(len(fade), burst_length // 2)
+            burst[:fade_length] *= fade[:fade_length]
+            burst[burst_length - fade_length:] *= fade[:fade_length][::-1]
+            file.write(burst)
+        file.write(noise.normal(0, 1e-4, sample_rate).astype(np.float32))
+
+# Generates a synthetic session into its folder: the recording, the dialogue file and the Transcript.txt that the
+# transcriber would give for it, with retakes, misses and transcription noise, so that no Whisper model is needed.
+# Sessions already generated with the same size and seed are reused
+def generate_session(directory, segment_count, minutes, seed, sample_rate):
+    audio_path = os.path.join(directory, "audio.wav")
+    dialogue_path = os.path.join(directory, "dialogue.txt")
+    if os.path.exists(os.path.join(directory, "session.json")):
+        return (audio_path, dialogue_path)
+    os.makedirs(directory, exist_ok=True)
+
+    # Retakes and repeats make the transcript longer than the script, so the script is shrunk to about the requested amount of segments
+    rng = random.Random(seed)
+    line_count = segment_count
+    for _ in range(2):
+        (lines, ids, vocabulary) = generate_script(line_count, rng)
+        (transcript, _, _) = generate_transcript(lines, vocabulary, rng, sample_rate)
+        line_count = max(1, line_count * segment_count // len(transcript))
+    while len(transcript) < segment_count:
+        transcript += transcript[:segment_count - len(transcript)]
+    transcript = transcript[:segment_count]
+
+    with open(dialogue_path, 'w', encoding="utf-8") as file:
+        for line, id in zip(lines, ids):
+            file.write(f"{line}\t{id}\n")
+    with open(os.path.join(directory, "Transcript.txt"), 'w', encoding="utf-8") as file:
+        for transcript_line in transcript:
+            file.write(transcript_line + '\n')
+    generate_audio(audio_path, segment_count, minutes, sample_rate, rng)
+
+    with open(os.path.join(directory, "session.json"), 'w') as file:
+        json.dump({"segments": segment_count, "minutes": minutes, "seed": seed, "script_lines": len(lines)}, file)
+    return (audio_path, dialogue_path)
+
+# Cuts the session's recording into segments the same way AudioCutter does, timing the segmentation and the export apart
+def run_cutter(args):
+    start_time = time.perf_counter()
+    (y, sr, segments, timestamps) = AudioCutter.find_segments(args, args.workspace)
+    timings = {"segmentation": time.perf_counter() - start_time}
+
+    start_time = time.perf_counter()
+    segment_directory = os.path.join(args.workspace, "Segments")
+    AudioCutter.create_folder(segment_directory)
+    exporter = ClipExporter(segment_directory, args.export_format, args.export_workers, sr)
+    try:
+        for i, segment in AudioCutter.get_segment_audio(y, args, sr, segments):
+            exporter.write(AudioCutter.get_segment_filename(i), segment)
+    finally:
+        exporter.close()
+    AudioCutter.write_timestamps(args.workspace, timestamps)
+    timings["segment_export"] = time.perf_counter() - start_time
+    return (timings, {"segments_found": len(segments)})
+
+# Matches the pre-made transcript and saves the clips the same way ClipMaker does, timing the matching, the loading
+# of the audio, the trimming and the export apart
+def run_clip_maker(args):
+    with open(os.path.join(args.workspace, "Transcript.txt"), 'r', encoding="utf-8") as file:
+        transcript = [ClipMaker.normalize_string(line.strip()) for line in file]
+    with open(os.path.join(args.workspace, "Timestamps.txt"), 'r') as file:
+        timestamps = [[int(num) for num in line.strip().split(',')] for line in file]
+    # The transcript is cut or padded to the segments that were found, should they differ from the generated ones
+    transcript = (transcript + [""] * len(timestamps))[:len(timestamps)]
+    (lines, ids) = ClipMaker.read_dialogue_file(args.dialogue)
+    lines = [ClipMaker.normalize_string(line) for line in lines]
+
+    start_time = time.perf_counter()
+    scores = ClipMaker.SimilarityCache(lines, transcript, args.similarity_cache_size)
+    index = ClipMaker.ScriptIndex(lines) if args.lookup == "index" else None
+    match_function = ClipMaker.match_transcript_aligned if args.matcher == "align" else ClipMaker.match_transcript
+    (final_timestamps, filenames, _) = match_function(lines, ids, transcript, timestamps, args, scores, index, TraceLog(None, TRACE_OFF))
+    timings = {"matching": time.perf_counter() - start_time}
+
+    start_time = time.perf_counter()
+    sr = args.sample_rate
+    if args.extraction == "seek":
+        y = SeekableAudio(args.audio, sr)
+    else:
+        y, sr = load_audio(args.audio, sr)
+    timings["audio_loading"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    (first_samples, last_samples) = ClipMaker.find_clip_edges(y, final_timestamps, args)
+    trimmed_timestamps = ClipMaker.trim_timestamps(final_timestamps, first_samples, last_samples, args, sr, len(y))
+    timings["trimming"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    clip_directory = os.path.join(args.workspace, "Clips")
+    AudioCutter.create_folder(clip_directory)
+    exporter = ClipExporter(clip_directory, args.export_format, args.export_workers, sr)
+    try:
+        for (start, end), filename in zip(trimmed_timestamps, filenames):
+            exporter.write(f"{ClipMaker.get_timestamp(start, sr)}__{filename}", y[start:end])
+    finally:
+        exporter.close()
+    timings["export"] = time.perf_counter() - start_time
+    return (timings, {"clips": len(filenames)})
+
+# Runs a stage in a fresh process, so its peak memory use is measured apart from the other stages and the generation
+def run_stage_process(stage, args, results):
+    try:
+        (timings, counts) = stage(args)
+        results.put((timings, counts, get_peak_rss()))
+    except BaseException as error:
+        results.put(error)
+
+def run_isolated(stage, args):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_stage_process, args=(stage, args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+# Runs AudioCutter and ClipMaker over synthetic sessions of every size, given as "segments:minutes", measuring the
+# time taken by every stage and the peak memory use of each script. The caches are turned off, so every run decodes the audio
+def benchmark_stages(options):
+    results = []
+    for size in options.sizes:
+        (segment_count, minutes) = size.split(":")
+        (segment_count, minutes) = (int(segment_count), float(minutes))
+        directory = os.path.join(options.sessions, f"session_{segment_count}_{minutes:g}_{options.seed}")
+        start_time = time.perf_counter()
+        (audio_path, dialogue_path) = generate_session(directory, segment_count, minutes, options.seed, options.sample_rate)
+        print(f"Session of {segment_count} segments, {minutes:g} minutes ready in {time.perf_counter() - start_time:.1f}s")
+
+        args = get_default_args(audio=audio_path, dialogue=dialogue_path, workspace=directory, sample_rate=options.sample_rate,
+                                analysis_rate=options.analysis_rate, streaming=options.streaming, extraction=options.extraction,
+                                audio_cache=0, envelope=0)
+        with open(os.path.join(directory, "args.json"), 'w') as file:
+            json.dump(vars(args), file)
+
+        for stage in [run_cutter, run_clip_maker]:
+            (timings, counts, peak_rss) = run_isolated(stage, args)
+            for name, seconds in timings.items():
+                result = {
+                    "stage": name,
+                    "extraction": options.extraction,
+                    "streaming": options.streaming,
+                    "analysis_rate": options.analysis_rate,
+                    "segments": segment_count,
+                    "minutes": minutes,
+                    "seconds": seconds,
+                    "peak_rss_mb": peak_rss,
+                    **counts,
+                }
+                results.append(result)
+                peak = f"{peak_rss:.0f} MB peak" if peak_rss is not None else "peak unknown"
+                print(f"{name:>15} {segment_count:6d} segments {minutes:6g} minutes: {seconds:8.3f}s, {peak}")
+    return results
+
+# Scripts whose startup is measured, and the modules that take seconds to import, which none of them may import
+# before a code path needs them
+IMPORTED_SCRIPTS = ["AudioCutter", "Transcriber", "ClipMaker", "FileRenamer", "Pipeline", "Batch", "TranscriptionService"]
+HEAVY_MODULES = ["librosa", "numba", "scipy", "torch", "whisper"]
+
+# Imports every script in a fresh interpreter, measuring the fastest of the repeated imports and listing the heavy
+# modules that were imported along with it
+def benchmark_imports(options):
+    code = ("import sys, time, json; start = time.perf_counter(); import {script}; "
+            "print(json.dumps([time.perf_counter() - start, sorted(set(name.split('.')[0] for name in sys.modules))]))")
+    results = []
+    for script in IMPORTED_SCRIPTS:
+        timings = []
+        for _ in range(options.repeats):
+            output = subprocess.run([sys.executable, "-c", code.format(script=script)], cwd=get_dir(),
+                                    capture_output=True, text=True, check=True).stdout
+            (seconds, modules) = json.loads(output.strip().splitlines()[-1])
+            timings.append(seconds)
+        result = {
+            "stage": "import",
+            "script": script,
+            "seconds": min(timings),
+            "heavy_modules": [module for module in HEAVY_MODULES if module in modules],
+        }
+        results.append(result)
+        heavy = ", ".join(result["heavy_modules"]) or "none"
+        print(f"{script:>20}: {result['seconds']:.3f}s, heavy modules: {heavy}")
+    return results
+
+# Reports the scripts importing heavy modules or taking longer than the limit to import, returning whether there were none
+def check_imports(results, max_seconds):
+    passed = True
+    for result in results:
+        if result["heavy_modules"]:
+            print(f"{result['script']} imports {', '.join(result['heavy_modules'])} at startup")
+            passed = False
+        if max_seconds > 0 and result["seconds"] > max_seconds:
+            print(f"{result['script']} takes {result['seconds']:.3f}s to import, more than the limit of {max_seconds}s")
+            passed = False
+    return passed
+
+# Prints how the results changed against the ones with the same fields in a former results file
+def compare_results(results, previous_path):
+    with open(previous_path, 'r') as file:
+        previous = {tuple(result.get(field) for field in RESULT_FIELDS): result for result in json.load(file)}
+    for result in results:
+        key = tuple(result.get(field) for field in RESULT_FIELDS)
+        description = " ".join(f"{field}={value}" for field, value in zip(RESULT_FIELDS, key) if value is not None)
+        if key not in previous:
+            print(f"{description}: no former result")
+            continue
+        change = result["seconds"] / max(previous[key]["seconds"], 1e-9)
+        line = f"{description}: {previous[key]['seconds']:.3f}s -> {result['seconds']:.3f}s ({change:.2f}x)"
+        if result.get("peak_rss_mb") is not None and previous[key].get("peak_rss_mb") is not None:
+            line += f", peak {previous[key]['peak_rss_mb']:.0f} MB -> {result['peak_rss_mb']:.0f} MB"
+        print(line)
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description="Benchmarks for the processing stages, run on synthetic sessions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join(get_dir(), "benchmark.json"))
+    parser.add_argument("--compare", default=None)
+
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    matchers_parser = subparsers.add_parser("matchers", help="compare the greedy and the alignment matcher")
+    matchers_parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 3000])
+    matchers_parser.add_argument("--matchers", nargs="+", choices=["greedy", "align"], default=["greedy", "align"])
+    matchers_parser.add_argument("--lookup", choices=["window", "index"], default="window")
+
+    stages_parser = subparsers.add_parser("stages", help="time every stage of AudioCutter and ClipMaker on synthetic recordings")
+    stages_parser.add_argument("--sizes", nargs="+", default=["100:10", "1000:60"])
+    stages_parser.add_argument("--sessions", default=os.path.join(get_dir(), "BenchmarkSessions"))
+    stages_parser.add_argument("--sample_rate", type=int, default=48000)
+    stages_parser.add_argument("--analysis_rate", type=int, default=0)
+    stages_parser.add_argument("--streaming", type=int, default=0)
+    stages_parser.add_argument("--extraction", choices=["memory", "seek"], default="memory")
+
+    imports_parser = subparsers.add_parser("imports", help="time the startup of every script and check it imports no heavy modules")
+    imports_parser.add_argument("--repeats", type=int, default=5)
+    imports_parser.add_argument("--max_seconds", type=float, default=0)
+
+    options = parser.parse_args()
+    if options.benchmark == "stages":
+        results = benchmark_stages(options)
+    elif options.benchmark == "imports":
+        results = benchmark_imports(options)
+    else:
+        results = benchmark_matchers(options)
+
+    if options.compare is not None:
+        compare_results(results, options.compare)
+    with open(options.output, 'w') as file:
+        json.dump(results, file, indent=4)
+
+    # Failing the run lets a build script stop on a slower startup
+    if options.benchmark == "imports" and not check_imports(results, options.max_seconds):
+        sys.exit(1)
@@ -0,0 +1,65 @@
+import os
+import time
+import threading
+import soundfile as sf
+from concurrent.futures import ThreadPoolExecutor
+
+# Encodings the audio files can be saved in, as the soundfile format, subtype and file extension
+EXPORT_FORMATS = {
+    "PCM_16": ("WAV", "PCM_16", ".wav"),
+    "PCM_24": ("WAV", "PCM_24", ".wav"),
+    "PCM_32": ("WAV", "PCM_32", ".wav"),
+    "FLOAT": ("WAV", "FLOAT", ".wav"),
+    "FLAC": ("FLAC", "PCM_24", ".flac"),
+}
+
+# Saves audio files into a folder over a pool of threads, so that writing one file doesn't wait for the one before,
+# which matters most on network storage. Only a few files per thread are held waiting to be written at a time,
+# so handing over files blocks once the writes fall behind
+class ClipExporter:
+    def __init__(self, directory, export_format, workers, sr):
+        (self.format, self.subtype, self.extension) = EXPORT_FORMATS[export_format]
+        self.directory = directory
+        self.sr = sr
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.pending = threading.BoundedSemaphore(2 * max(1, workers))
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.error = None
+        self.start_time = time.perf_counter()
+
+    # Saves the audio under the filename, with its extension replaced by the one of the export format
+    def write(self, filename, audio):
+        if self.error is not None:
+            raise self.error
+        path = os.path.join(self.directory, os.path.splitext(filename)[0] + self.extension)
+        self.pending.acquire()
+        self.pool.submit(self.write_file, path, audio)
+
+    # Files are written under a temporary name and then moved over the former file, which replaces it with a new file
+    # rather than rewriting it, so hard links to the former file, such as the ones of FileRenamer, keep their audio
+    def write_file(self, path, audio):
+        try:
+            temporary_path = path + ".tmp"
+            sf.write(temporary_path, audio, self.sr, format=self.format, subtype=self.subtype)
+            os.replace(temporary_path, path)
+            size = os.path.getsize(path)
+            with self.lock:
+                self.files += 1
+                self.bytes += size
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.pending.release()
+
+    # Waits for all the files to be written, raising the first error any of the writes stopped on
+    def close(self):
+        self.pool.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start_time
+        megabytes = self.bytes / (1 << 20)
+        return f"Exported {self.files} files, {megabytes:.1f} MB in {elapsed:.2f}s, {megabytes / max(elapsed, 1e-9):.1f} MB/s"
@@ -1,12 +1,27 @@
 import os
 import editdistance
-import librosa
-import soundfile as sf
 import sys
-import shutil
 import argparse
 import json
 import re
+import time
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+
+from AudioCache import save_audio_cache, load_audio_cache, load_envelope, get_audio_key, resolve_sample_rate, load_audio, SeekableAudio
+from ClipExport import ClipExporter, EXPORT_FORMATS
+from Instrumentation import TraceLog, TRACE_OFF, TRACE_DECISIONS, TRACE_STEPS
+import Instrumentation
+from collections import OrderedDict
+
+# rapidfuzz is optional, when installed it computes the whole similarity matrix natively on all workers
+try:
+    from rapidfuzz import process as rapidfuzz_process
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    rapidfuzz_process = None
 
 # Gets the path relative to either .py or .exe location
 def get_dir():
@@ -16,25 +31,6 @@ def get_dir():
         dir = os.path.dirname(os.path.abspath(__file__))
     return dir
 
-# Creates folder if one doesn't exist before
-def create_folder(path):
-    if not os.path.exists(path):
-        os.makedirs(path)
-    else:
-        shutil.rmtree(path)
-        os.makedirs(path)
-
-# Generates all possible ways that words could be broken down to sentences
-def generate_sentences(words):
-    sentences = []
-    for i in range(len(words)):
-        for j in range(i + 1, len(words)  + 1):
-            sentence = words[i]
-            for k in range(i + 1, j):
-                sentence += " " + words[k]
-            sentences.append(sentence)
-    return sentences
-
 # Normalizes a string to be only lower-case characters and spaces, removing special expresions
 def normalize_string(input_str):
     if input_str is None:
@@ -64,17 +60,61 @@ def get_similarity(string1, string2):
     max_len = max(len(string1), len(string2))
     return 1 - (distance / max_len)
 
+# Finds the span of whole words in full_string that is the most similar to possible_substring.
+# Spans are scored with the same ratio as get_similarity, but only spans whose length can still reach
+# the threshold are compared, as the edit distance is never smaller than the difference in lengths.
+# Every span is still compared with an edit distance of its own, so the cost grows with the square of the words
+# in the line, and the threshold alone is what keeps it low: the higher it is, the fewer spans are compared.
+# Returns the best span and its similarity, or an empty span with similarity 0 if no span qualified
+def find_best_substring(full_string, possible_substring, threshold):
+    words = full_string.split()
+    if len(words) == 0 or len(possible_substring) == 0:
+        return ("", 0)
+
+    # Spans are sliced out of the re-joined line instead of being concatenated word by word
+    line = " ".join(words)
+    starts = []
+    ends = []
+    offset = 0
+    for word in words:
+        starts.append(offset)
+        offset += len(word)
+        ends.append(offset)
+        offset += 1
+
+    # Span length limits, loosened by a character so that float rounding never excludes a valid span
+    substring_length = len(possible_substring)
+    min_length = threshold * substring_length - 1
+    max_length = substring_length / threshold + 1 if threshold > 0 else len(line)
+
+    best_span = ""
+    best_similarity = 0
+    for i, start in enumerate(starts):
+        for end in ends[i:]:
+            span_length = end - start
+            if span_length < min_length:
+                continue
+            if span_length > max_length:
+                break
+            span = line[start:end]
+            similarity = get_similarity(span, possible_substring)
+            if similarity > best_similarity:
+                best_span = span
+                best_similarity = similarity
+    return (best_span, best_similarity)
+
 # Checks if possible_substring is likely to be a real substring of full_string using similarity threshold
 def is_string_substring(full_string, possible_substring, threshold):
+    similarity = get_substring_similarity(full_string, possible_substring, threshold)
+    return similarity is not None and similarity >= threshold
+
+# Similarity of the best substring of full_string to possible_substring, or None if it is too long to be a substring.
+# Substrings that can't reach the threshold are skipped, so the result answers every threshold at least as high as it
+def get_substring_similarity(full_string, possible_substring, threshold):
     if len(possible_substring) == 0 or len(possible_substring) / len(full_string) > 0.99:
-        return False
-    words = full_string.split()
-    substrings = generate_sentences(words)
-    for substring in substrings:
-        similarity = get_similarity(substring, possible_substring)
-        if similarity >= threshold:
-            return True
-    return False
+        return None
+    (_, similarity) = find_best_substring(full_string, possible_substring, threshold)
+    return similarity
 
 # Checks if two strings can be considered similar enough to be treated as a perfect match
 def is_perfect_match(string1, string2, threshold):
@@ -83,6 +123,72 @@ def is_perfect_match(string1, string2, threshold):
         return True
     return False
 
+# Bounded cache of the scores between script lines and transcript lines, addressed by their indexes.
+# The matching loop and its logging both read from it, so every pair is scored only once per run.
+# Least recently used entries are evicted once the cache is full
+class SimilarityCache:
+    def __init__(self, lines, transcript, max_size, matrix=None):
+        self.lines = lines
+        self.transcript = transcript
+        self.max_size = max_size
+        # Precomputed edit distances of every transcript line to every script line, if available
+        self.matrix = matrix
+        self.line_lengths = [len(line) for line in lines]
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_score(self, key, score_function):
+        if key in self.scores:
+            self.hits += 1
+            self.scores.move_to_end(key)
+            return self.scores[key]
+
+        self.misses += 1
+        score = score_function()
+        self.scores[key] = score
+        if len(self.scores) > self.max_size:
+            self.scores.popitem(last=False)
+            self.evictions += 1
+        return score
+
+    # Sentence made by joining the transcript lines from start to end, both included
+    def sentence(self, start, end):
+        return " ".join(self.transcript[start:end + 1])
+
+    # Similarity between a script line and the sentence made of transcript lines from start to end
+    def similarity(self, lidx, start, end):
+        if self.matrix is not None and start == end:
+            if self.line_lengths[lidx] == 0 or len(self.transcript[start]) == 0:
+                return 0
+            max_len = max(self.line_lengths[lidx], len(self.transcript[start]))
+            return 1 - (int(self.matrix[start, lidx]) / max_len)
+        return self.get_score(("similarity", lidx, start, end),
+                              lambda: get_similarity(self.lines[lidx], self.sentence(start, end)))
+
+    def substring(self, lidx, tidx, threshold):
+        return self.get_score(("substring", lidx, tidx, threshold),
+                              lambda: is_string_substring(self.lines[lidx], self.transcript[tidx], threshold))
+
+    def perfect_match(self, lidx, start, end, threshold):
+        return self.similarity(lidx, start, end) >= threshold
+
+    def stats(self):
+        return f"Similarity cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
+# Scores shared by all the configurations of a sweep. Substring checks are cached by their similarity rather than by
+# their result, computed with the lowest substring threshold of the sweep, so one score answers every threshold
+class SweepScores(SimilarityCache):
+    def __init__(self, lines, transcript, max_size, matrix, substring_threshold):
+        super().__init__(lines, transcript, max_size, matrix)
+        self.substring_threshold = substring_threshold
+
+    def substring(self, lidx, tidx, threshold):
+        similarity = self.get_score(("substring", lidx, tidx),
+                                    lambda: get_substring_similarity(self.lines[lidx], self.transcript[tidx], self.substring_threshold))
+        return similarity is not None and similarity >= threshold
+
 # Converts the int value of the audio segment timestamps into concrete min-sec-millisec value for the audio file
 def get_timestamp(old_timestamp, sr):
     seconds = old_timestamp / sr
@@ -107,6 +213,143 @@ def read_dialogue_file(filename):
     ids = [item[1] for item in sentences_with_titles]
     return (lines, ids)
 
+# Script lines shared with the worker processes that compute the rows of the similarity matrix
+matrix_lines = None
+
+def init_matrix_worker(lines):
+    global matrix_lines
+    matrix_lines = lines
+
+# Edit distances between one transcript line and every script line
+def get_distance_row(transcript_line):
+    return [editdistance.eval(line, transcript_line) for line in matrix_lines]
+
+# Identifies the normalized script and transcript a similarity matrix was computed for
+def get_matrix_fingerprint(lines, transcript):
+    content = "\n".join(lines) + "\0" + "\n".join(transcript)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+# Computes the edit distances of every transcript line to every script line, spread over worker processes.
+# Distances are stored instead of similarity ratios, as they are smaller and give the exact same ratios back
+def build_similarity_matrix(lines, transcript, workers):
+    longest = max([len(line) for line in lines] + [len(line) for line in transcript] + [0])
+    dtype = np.uint16 if longest < np.iinfo(np.uint16).max else np.uint32
+    if rapidfuzz_process is not None and len(transcript) > 0 and len(lines) > 0:
+        return rapidfuzz_process.cdist(transcript, lines, scorer=Levenshtein.distance, dtype=dtype, workers=workers)
+
+    matrix = np.zeros((len(transcript), len(lines)), dtype=dtype)
+
+    if workers <= 1 or len(transcript) < workers:
+        init_matrix_worker(lines)
+        for tidx, transcript_line in enumerate(transcript):
+            matrix[tidx] = get_distance_row(transcript_line)
+    else:
+        chunksize = max(1, len(transcript) // (workers * 8))
+        with multiprocessing.Pool(workers, initializer=init_matrix_worker, initargs=(lines,)) as pool:
+            for tidx, row in enumerate(pool.imap(get_distance_row, transcript, chunksize)):
+                matrix[tidx] = row
+    return matrix
+
+# Converts edit distances into similarity ratios for a whole matrix at once, the same way get_similarity does
+def get_similarity_ratios(matrix, lines, transcript):
+    line_lengths = np.array([len(line) for line in lines])
+    transcript_lengths = np.array([len(line) for line in transcript])
+    max_lengths = np.maximum(transcript_lengths[:, None], line_lengths[None, :])
+    ratios = 1 - (matrix / np.maximum(max_lengths, 1))
+    ratios[transcript_lengths == 0, :] = 0
+    ratios[:, line_lengths == 0] = 0
+    return ratios
+
+def save_similarity_matrix(directory, matrix, lines, transcript):
+    np.save(os.path.join(directory, "SimilarityMatrix.npy"), matrix)
+    with open(os.path.join(directory, "SimilarityMatrix.json"), 'w') as file:
+        json.dump({"fingerprint": get_matrix_fingerprint(lines, transcript), "shape": list(matrix.shape)}, file)
+
+# Opens a saved similarity matrix memory-mapped, as long as it was computed for the same script and transcript
+def load_similarity_matrix(directory, lines, transcript):
+    matrix_path = os.path.join(directory, "SimilarityMatrix.npy")
+    info_path = os.path.join(directory, "SimilarityMatrix.json")
+    if not os.path.exists(matrix_path) or not os.path.exists(info_path):
+        return None
+    with open(info_path, 'r') as file:
+        info = json.load(file)
+    if info["fingerprint"] != get_matrix_fingerprint(lines, transcript):
+        return None
+    return np.load(matrix_path, mmap_mode='r')
+
+# Arguments the results of the matching depend on
+MATCH_ARGS = ["substring_threshold", "match_threshold_short", "match_threshold_long", "short_long_separator", "backtrack_limit",
+              "forwardtrack_limit", "max_random_name_length", "lookup", "lookup_candidates", "matcher", "align_max_merge"]
+
+# Identifies the inputs of a stage by their contents
+def get_stage_fingerprint(*inputs):
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+# Results of every stage of a former run, saved into ClipMakerState.json along with the fingerprint of their inputs.
+# A rerun takes the results of the stages whose inputs stayed the same instead of redoing them
+class ClipMakerState:
+    def __init__(self, directory):
+        self.path = os.path.join(directory, "ClipMakerState.json")
+        self.stages = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding="utf-8") as file:
+                self.stages = json.load(file)
+
+    # Returns the saved results of the stage, or None if its inputs changed since
+    def get(self, stage, fingerprint):
+        saved = self.stages.get(stage)
+        if saved is None or saved["fingerprint"] != fingerprint:
+            return None
+        return saved["results"]
+
+    def set(self, stage, fingerprint, results):
+        self.stages[stage] = {"fingerprint": fingerprint, "results": results}
+
+    # The state is written to a temporary file first, so a run that stops while saving never corrupts it
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w', encoding="utf-8") as file:
+            json.dump(self.stages, file)
+        os.replace(temporary_path, self.path)
+
+# Lists the clip files of the run in the order they were made, so FileRenamer can order them without reading the Clips
+# folder. Written to a temporary file first, the same as the state
+def save_clip_manifest(directory, clip_filenames):
+    manifest_path = os.path.join(directory, "ClipManifest.json")
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, 'w', encoding="utf-8") as file:
+        json.dump({"folder": "Clips", "clips": clip_filenames}, file)
+    os.replace(temporary_path, manifest_path)
+
+def get_file_stat(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+# Splits a string into the set of its character trigrams, with spaces marking where the string starts and ends
+def get_trigrams(input_str):
+    padded = f" {input_str} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+# Inverted index from character trigrams to the script lines that contain them. Used to find the script
+# lines most likely to match a transcript line by only visiting the lines that share trigrams with it
+class ScriptIndex:
+    def __init__(self, lines):
+        self.postings = {}
+        for lidx, line in enumerate(lines):
+            for trigram in get_trigrams(line):
+                self.postings.setdefault(trigram, []).append(lidx)
+
+    # Returns up to count script line indexes, ordered by how many trigrams they share with the text
+    def candidates(self, text, count):
+        shared = {}
+        for trigram in get_trigrams(text):
+            for lidx in self.postings.get(trigram, ()):
+                shared[lidx] = shared.get(lidx, 0) + 1
+        return sorted(shared, key=lambda lidx: (-shared[lidx], lidx))[:count]
+
+# Counts the takes of every found script line
 def update_instance_count(dictionary, index, ids):
     if ids[index] in dictionary:
         dictionary[ids[index]] += 1
@@ -114,61 +357,29 @@ def update_instance_count(dictionary, index, ids):
         dictionary[ids[index]] = 1
     return dictionary
 
-def get_match_threshold_by_length(len):
+# Picks the match threshold for a script line based on its length
+def get_match_threshold_by_length(len, args):
     if len > args.short_long_separator:
         return args.match_threshold_long
     return args.match_threshold_short
 
-def main(args):
-    # log.txt will store the execution steps of the algorithm and thus help debugging
-    log = open("log.txt", "w", encoding="utf8")
-
-    # Definitions for filepaths used in the script
-    directory = get_dir()
-    audio_path = args.audio
-    dialogue_path = args.dialogue
-    transcript_path = os.path.join(directory, "Transcript.txt")
-    timestamps_path = os.path.join(directory, "Timestamps.txt")
-    final_directory = os.path.join(directory, "Clips")
-    not_found_path = os.path.join(directory, "NotFound.txt")
-
-    create_folder(final_directory)
-
-    # Processing audiofile to get stream and sample rate
-    y, sr = librosa.load(audio_path, sr = args.sample_rate)
-
-
-    # Read the outputs of the transcript and the audio segment timestamps
-    with open(transcript_path, 'r', encoding="utf8") as file:
-        transcript = file.readlines()
-    transcript = [string.strip() for string in transcript]
-    transcript = [normalize_string(string) for string in transcript]
-
-    with open(timestamps_path, 'r') as file:
-        timestamps = file.readlines()
-    timestamps = [string.strip() for string in timestamps]
-    timestamps = [[int(num) for num in string.split(',')] for string in timestamps]
-
-
-    # Gets the dialogue lines and the filenames that they need to have (ids)
-    (lines, ids) = read_dialogue_file(dialogue_path)
-    # Original values are saved for the purpose of printing out original line contents in the NotFound.txt file
-    not_normalized = lines    
-    lines = [normalize_string(string) for string in lines]
-
-    # Script lines that are normalized to empty strings can't be found via the algorithm and will be saved here. 
-    empty_line_ids = []
-    to_remove = []
-    for i in range(len(lines)):
-        if not lines[i]:
-            empty_line_ids.append(ids[i] + "   " + not_normalized[i] + "\n")
-            to_remove.append(i)
-
-    for i in reversed(to_remove):
-        del ids[i]
-        del lines[i]
-        del not_normalized[i]
-    
+# Unknown's filename contains the transcribed value, trimmed in case it is too long for a filename
+def get_unknown_name(transcript_line, max_random_name_length):
+    unknown_name = "UNKNOWN__" + transcript_line.replace(" ", "_")
+    if len(unknown_name) > max_random_name_length:
+        unknown_name = unknown_name[:max_random_name_length]
+    return unknown_name
+
+# Hands the last added clip over to on_clip, so it can be saved while the matching goes on
+def pass_on_clip(on_clip, final_timestamps, filenames):
+    if on_clip is not None:
+        on_clip(final_timestamps[-1], filenames[-1])
+
+# Greedy matching of the transcript lines against the script lines. When a script index is given, failed
+# matches are looked up among its candidates instead of stepping back and forth through the script.
+# Returns the timestamps and filenames of every clip to be cut, along with the count of takes of every script line id.
+# Every clip is also passed to on_clip as soon as it is found
+def match_transcript(lines, ids, transcript, timestamps, args, scores, index, log, on_clip=None):
     # Initializing variables for the matching algorithm
 
     # Timestamps will be used for cutting the correct audio segment and adding the timestamp to the filename
@@ -192,6 +403,9 @@ def main(args):
     forwardtrack = 0
     forwardtrack_limit = args.forwardtrack_limit
 
+    # Candidate script lines left to check while the look-up is done through the script index
+    candidates = None
+
     # Parameter for naming unidentified files - the filename stores the transcripted dialogue which can otherwise overflow the name limit
     max_random_name_length = args.max_random_name_length
     
@@ -203,32 +417,33 @@ def main(args):
         if  lidx >= len(lines):
             lidx = 0
         
-        log.writelines(f"Current transcript line: {transcript[tidx]}\n")
+        log.write(TRACE_STEPS, "Current transcript line: {}\n", transcript[tidx])
         if tidx + 1 < len(transcript):
-            log.writelines(f"Following transcript line:   {transcript[tidx + 1]}\n")
+            log.write(TRACE_STEPS, "Following transcript line:   {}\n", transcript[tidx + 1])
         else:
-            log.writelines(f"Following transcript line doesn't exist\n")
+            log.write(TRACE_STEPS, "Following transcript line doesn't exist\n")
             
-        log.writelines(f"Current script line:     {lines[lidx]}\n")
+        log.write(TRACE_STEPS, "Current script line:     {}\n", lines[lidx])
         if lidx + 1 < len(lines):
-            log.writelines(f"Following script line:   {lines[lidx + 1]}\n")
+            log.write(TRACE_STEPS, "Following script line:   {}\n", lines[lidx + 1])
         else:
-            log.writelines(f"Following script line doesn't exist\n")
+            log.write(TRACE_STEPS, "Following script line doesn't exist\n")
 
         # Catches transcripts that failed to identify any text
         if len(transcript[tidx]) == 0:
 
             final_timestamps.append([timestamps[tidx][0], timestamps[tidx][1]])
             filenames.append(f"UNIDENTIFIED.wav")
-            log.writelines(f"No match found after forward and backtrack, saving as UNIDENTIFIED.wav\n\n")
+            pass_on_clip(on_clip, final_timestamps, filenames)
+            log.write(TRACE_DECISIONS, "No match found after forward and backtrack, saving as UNIDENTIFIED.wav\n\n")
             tidx += 1
             continue
 
         # Checks if the transcript line is either a substring of or a match with the script line
-        if tidx < len(transcript) - 1 and (is_string_substring(lines[lidx], transcript[tidx], args.substring_threshold) 
-                                           or is_perfect_match(lines[lidx], transcript[tidx], get_match_threshold_by_length(len(lines[lidx])))):
+        if tidx < len(transcript) - 1 and (scores.substring(lidx, tidx, args.substring_threshold)
+                                           or scores.perfect_match(lidx, tidx, tidx, get_match_threshold_by_length(len(lines[lidx]), args))):
 
-            log.writelines(f"Found possible match with current line\n")
+            log.write(TRACE_STEPS, "Found possible match with current line\n")
 
             # The current index is saved in case its incremented while finding sunbstrings but the final result fails to match
             start_tidx = tidx
@@ -240,52 +455,54 @@ def main(args):
             clip_end = timestamps[tidx]
 
             # while booleans duplicated for debugging
-            is_next_substring = is_string_substring(lines[lidx], transcript[tidx + 1], args.substring_threshold)
-            does_similarity_improve = get_similarity(lines[lidx], sentence) < get_similarity(lines[lidx], sentence + " " + transcript[tidx + 1])
-            log.writelines(f"Next is substring: {is_next_substring}\n")
-            log.writelines(f"Similarity improves: {does_similarity_improve}\n")
+            is_next_substring = scores.substring(lidx, tidx + 1, args.substring_threshold)
+            does_similarity_improve = scores.similarity(lidx, start_tidx, tidx) < scores.similarity(lidx, start_tidx, tidx + 1)
+            log.write(TRACE_STEPS, "Next is substring: {}\n", is_next_substring)
+            log.write(TRACE_STEPS, "Similarity improves: {}\n", does_similarity_improve)
             
             # while cycle that takes in more transcribed lines to expand the sentence, so long as it is a substring of the script line and the similarity improves for the sentence with the script line
-            while (is_string_substring(lines[lidx], transcript[tidx + 1], args.substring_threshold) and 
-                   get_similarity(lines[lidx], sentence) < get_similarity(lines[lidx], sentence + " " + transcript[tidx + 1])):
+            while (tidx + 1 < len(transcript) and scores.substring(lidx, tidx + 1, args.substring_threshold) and
+                   scores.similarity(lidx, start_tidx, tidx) < scores.similarity(lidx, start_tidx, tidx + 1)):
                 tidx += 1
                 sentence += " " + transcript[tidx]
                 # End timestamp is changed to be the timestamp of the new added transcript line
                 clip_end = timestamps[tidx]
-                log.writelines(f"Current substring: {sentence}\n")
+                log.write(TRACE_STEPS, "Current substring: {}\n", sentence)
 
-            log.writelines(f"Checking for match between: \nT: {sentence}\nL: {lines[lidx]}\n")
+            log.write(TRACE_STEPS, "Checking for match between: \nT: {}\nL: {}\n", sentence, lines[lidx])
 
             # This if filters out non-matching sentences, mainly intended to filter out random strings that satisfied initial if by being substrings of some part of the script line
-            if is_perfect_match(lines[lidx], sentence, get_match_threshold_by_length(len(lines[lidx]))):
+            if scores.perfect_match(lidx, start_tidx, tidx, get_match_threshold_by_length(len(lines[lidx]), args)):
                 
-                log.writelines(f"Match found!\n")
+                log.write(TRACE_STEPS, "Match found!\n")
 
                 # Saves the data for cutting up the main audio file: timestamp of when to start and end cut as well as the files name
                 final_timestamps.append([clip_start[0], clip_end[1]])
                 update_instance_count(id_dictionary, lidx, ids)
                 filenames.append(f"{ids[lidx]}__take_{id_dictionary[ids[lidx]]}.wav")
+                pass_on_clip(on_clip, final_timestamps, filenames)
 
-                log.writelines(f"Saving substring match as {ids[lidx]}__take_{id_dictionary[ids[lidx]]}.wav\n")
+                log.write(TRACE_DECISIONS, "Saving substring match as {}__take_{}.wav\n", ids[lidx], id_dictionary[ids[lidx]])
 
                 tidx += 1
                 backtrack = 0
                 forwardtrack = 0
+                candidates = None
                 
-                log.writelines("\n")    
+                log.write(TRACE_STEPS, "\n")    
                 continue
 
             else:
-                log.writelines(f"Not matching. Similarity only {get_similarity(lines[lidx], sentence)}\n")
+                log.write(TRACE_STEPS, "Not matching. Similarity only {}\n", scores.similarity(lidx, start_tidx, tidx))
                 tidx = start_tidx
         
 
         # Checks if the transcript line is either a substring of or a match with the NEXT script line
         # Main difference is that the script line index lidx gets incremented only in this case
-        if tidx < len(transcript) - 1 and lidx + 1 < len(lines) and (is_string_substring(lines[lidx + 1], transcript[tidx], args.substring_threshold)
-                                                                       or is_perfect_match(lines[lidx], transcript[tidx], get_match_threshold_by_length(len(lines[lidx + 1])))):
+        if tidx < len(transcript) - 1 and lidx + 1 < len(lines) and (scores.substring(lidx + 1, tidx, args.substring_threshold)
+                                                                       or scores.perfect_match(lidx, tidx, tidx, get_match_threshold_by_length(len(lines[lidx + 1]), args))):
             
-            log.writelines(f"Found possible match with the following line\n")
+            log.write(TRACE_STEPS, "Found possible match with the following line\n")
 
             start_tidx = tidx
 
@@ -293,40 +510,42 @@ def main(args):
             clip_start = timestamps[tidx]
             clip_end = timestamps[tidx]
 
-            is_next_substring = is_string_substring(lines[lidx + 1], transcript[tidx + 1], args.substring_threshold)
-            does_similarity_improve = get_similarity(lines[lidx + 1], sentence) < get_similarity(lines[lidx + 1], sentence + " " + transcript[tidx + 1])
-            log.writelines(f"Next is substring: {is_next_substring}\n")
-            log.writelines(f"Similarity improves: {does_similarity_improve}\n")
+            is_next_substring = scores.substring(lidx + 1, tidx + 1, args.substring_threshold)
+            does_similarity_improve = scores.similarity(lidx + 1, start_tidx, tidx) < scores.similarity(lidx + 1, start_tidx, tidx + 1)
+            log.write(TRACE_STEPS, "Next is substring: {}\n", is_next_substring)
+            log.write(TRACE_STEPS, "Similarity improves: {}\n", does_similarity_improve)
 
-            while (is_string_substring(lines[lidx + 1], transcript[tidx + 1], args.substring_threshold) and 
-                   get_similarity(lines[lidx + 1], sentence) < get_similarity(lines[lidx + 1], sentence + " " + transcript[tidx + 1])):
+            while (tidx + 1 < len(transcript) and scores.substring(lidx + 1, tidx + 1, args.substring_threshold) and
+                   scores.similarity(lidx + 1, start_tidx, tidx) < scores.similarity(lidx + 1, start_tidx, tidx + 1)):
                 tidx += 1
                 sentence += " " + transcript[tidx]
                 clip_end = timestamps[tidx]
-                log.writelines(f"Current substring: {sentence}\n")
+                log.write(TRACE_STEPS, "Current substring: {}\n", sentence)
 
-            log.writelines(f"Checking for match between: \nT: {sentence}\nL: {lines[lidx + 1]}\n")
+            log.write(TRACE_STEPS, "Checking for match between: \nT: {}\nL: {}\n", sentence, lines[lidx + 1])
 
-            if is_perfect_match(lines[lidx + 1], sentence, get_match_threshold_by_length(len(lines[lidx + 1]))):
+            if scores.perfect_match(lidx + 1, start_tidx, tidx, get_match_threshold_by_length(len(lines[lidx + 1]), args)):
             
-                log.writelines(f"Match found!\n")
+                log.write(TRACE_STEPS, "Match found!\n")
 
                 final_timestamps.append([clip_start[0], clip_end[1]])
                 update_instance_count(id_dictionary, lidx + 1, ids)
                 filenames.append(f"{ids[lidx + 1]}__take_{id_dictionary[ids[lidx + 1]]}.wav")
+                pass_on_clip(on_clip, final_timestamps, filenames)
                 
-                log.writelines(f"Saving substring match as {ids[lidx + 1]}__take_{id_dictionary[ids[lidx + 1]]}.wav\n")
+                log.write(TRACE_DECISIONS, "Saving substring match as {}__take_{}.wav\n", ids[lidx + 1], id_dictionary[ids[lidx + 1]])
 
                 lidx += 1
                 tidx += 1
                 backtrack = 0
                 forwardtrack = 0
+                candidates = None
 
-                log.writelines("\n")    
+                log.write(TRACE_STEPS, "\n")    
                 continue
 
             else:
-                log.writelines(f"Not matching. Similarity only {get_similarity(lines[lidx + 1], sentence)}\n")
+                log.write(TRACE_STEPS, "Not matching. Similarity only {}\n", scores.similarity(lidx + 1, start_tidx, tidx))
                 tidx = start_tidx
 
 
@@ -335,61 +554,594 @@ def main(args):
         # If this code is reached it means that the current lidx and tidx pair failed to get a match and a look-up is necessary
         # The look-up searches for a possible match between the current tidx and a series of prior and later lidx values
 
-        # Starting first with backtrack
-        if backtrack == 0:
-            log.writelines(f"Starting backtrack at {lidx}\n")
-            lidx_saved = lidx
+        # Index look-up tries the script lines sharing the most trigrams with the transcript line, best candidates first
+        if index is not None:
+            if candidates is None:
+                log.write(TRACE_STEPS, "Starting index lookup at {}\n", lidx)
+                Instrumentation.count("index_lookups")
+                lidx_saved = lidx
+                candidates = index.candidates(transcript[tidx], args.lookup_candidates)
+                # Negative limits let the look-up reach any line of the script
+                candidates = [candidate for candidate in candidates if candidate != lidx_saved
+                              and (backtrack_limit < 0 or candidate >= lidx_saved - backtrack_limit)
+                              and (forwardtrack_limit < 0 or candidate <= lidx_saved + forwardtrack_limit)]
+
+            lookup_failed = len(candidates) == 0
+            if not lookup_failed:
+                lidx = candidates.pop(0)
+                log.write(TRACE_STEPS, "Executing index lookup to {}\n", lidx)
+                Instrumentation.count("index_lookup_steps")
 
-        # lidx incremented while backtrack is bellow backtrack limit
-        if lidx > 0 and backtrack < backtrack_limit:
-            log.writelines(f"Executing backtrack to {lidx - 1}\n")
-            lidx -= 1
-            backtrack += 1
-        
-        # Forwardtracking if backtracking fails to get a match
         else:
-            backtrack = backtrack_limit
+            lookup_failed = False
 
-            # Same general logic as backtrack
-            if forwardtrack == 0:
-                log.writelines(f"Starting forwardtrack at {lidx}\n")
-                lidx = lidx_saved
+            # Starting first with backtrack
+            if backtrack == 0:
+                log.write(TRACE_STEPS, "Starting backtrack at {}\n", lidx)
+                lidx_saved = lidx
+
+            # lidx incremented while backtrack is bellow backtrack limit
+            if lidx > 0 and backtrack < backtrack_limit:
+                log.write(TRACE_STEPS, "Executing backtrack to {}\n", lidx - 1)
+                Instrumentation.count("backtrack_steps")
+                lidx -= 1
+                backtrack += 1
+
+            # Forwardtracking if backtracking fails to get a match
+            else:
+                backtrack = backtrack_limit
+
+                # Same general logic as backtrack
+                if forwardtrack == 0:
+                    log.write(TRACE_STEPS, "Starting forwardtrack at {}\n", lidx)
+                    lidx = lidx_saved
+
+                if lidx < len(lines) and forwardtrack < forwardtrack_limit:
+                    lidx += 1
+                    if lidx < len(lines):
+                        forwardtrack += 1
+                    else:
+                        forwardtrack = forwardtrack_limit
+
+                    log.write(TRACE_STEPS, "Executing forwardtrack to {}\n", lidx)
+                    Instrumentation.count("forwardtrack_steps")
 
-            if lidx < len(lines) and forwardtrack < forwardtrack_limit:
-                lidx += 1
-                if lidx < len(lines):
-                    forwardtrack += 1
                 else:
-                    forwardtrack = forwardtrack_limit
-            
-                log.writelines(f"Executing forwardtrack to {lidx}\n")
+                    lookup_failed = True
 
-            # If forwardtrack also fails, then the tidx transcript line is considered as unknown and is saved as such
+        # If the look-up also fails, then the tidx transcript line is considered as unknown and is saved as such
+        if lookup_failed:
+            unknown_name = get_unknown_name(transcript[tidx], max_random_name_length)
+
+            clip_start = timestamps[tidx]
+            clip_end = timestamps[tidx]
+            final_timestamps.append([clip_start[0], clip_end[1]])
+
+            filenames.append(f"{unknown_name}.wav")
+            pass_on_clip(on_clip, final_timestamps, filenames)
+
+            # Resets lidx to the original value before lookup
+            lidx = lidx_saved
+            # Increments tidx to bypass the unknown line
+            tidx += 1
+            backtrack = 0
+            forwardtrack = 0
+            candidates = None
+            log.write(TRACE_DECISIONS, "No match found after forward and backtrack, saving as {}.wav\n", unknown_name)
+
+        log.write(TRACE_STEPS, "\n")
+
+    return (final_timestamps, filenames, id_dictionary)
+
+# Costs of the alignment steps. Skipping a transcript line as unknown is the most expensive step, so that
+# any match within the band is preferred over it, and following the script in order is free
+ALIGN_UNKNOWN_COST = 1.0
+ALIGN_JUMP_COST = 0.5
+ALIGN_RETAKE_COST = 0.25
+# Small cost for imperfect matches, used to decide between equally placed candidates
+ALIGN_SIMILARITY_COST = 0.01
+
+# Script lines that can be aligned with the transcript line at tidx when the last matched script line is lidx.
+# The band spans the backtrack and forwardtrack limits and wraps around the end of the script, as recordings
+# sometimes repeat the script from the start. Candidates from the script index are added when one is given.
+# A limit of -1 leaves the search on that side to the index alone, past the retake and the next line
+def get_band(lidx, tidx, line_count, transcript, args, index):
+    band = set()
+    for candidate in range(lidx - max(args.backtrack_limit, 0), lidx + max(args.forwardtrack_limit, 0) + 2):
+        if candidate >= 0:
+            band.add(candidate % line_count)
+    if index is not None:
+        band.update(index.candidates(transcript[tidx], args.lookup_candidates))
+    return band
+
+# Alignment of the transcript lines against the script lines as a banded dynamic program. Every transcript line
+# is either matched to a script line, merged with the following transcript lines into a match, or skipped as
+# unknown, and the cheapest sequence of these steps is kept. Only the script lines within the band around the
+# best alignment so far are tried, which bounds the cost to O(transcript lines x band).
+# Returns the same results as match_transcript
+def match_transcript_aligned(lines, ids, transcript, timestamps, args, scores, index, log, on_clip=None):
+    # Alignments ending after every transcript line, as {last matched script line: (cost, previous tidx, previous line, step)}
+    # where step is the matched script line, or None for skipped transcript lines
+    alignments = [dict() for _ in range(len(transcript) + 1)]
+    alignments[0][-1] = (0, None, None, None)
+
+    for tidx in range(len(transcript)):
+        states = alignments[tidx]
+        if not states:
+            continue
+
+        # Only the cheapest alignments are carried forward, keeping the amount of states within the band.
+        # Without a limit on either side, the band has no fixed size and every alignment is kept
+        best_lidx = min(states, key=lambda lidx: states[lidx][0])
+        best_cost = states[best_lidx][0]
+        band_size = args.backtrack_limit + args.forwardtrack_limit + 2
+        if args.backtrack_limit >= 0 and args.forwardtrack_limit >= 0 and len(states) > band_size:
+            kept = sorted(states, key=lambda lidx: states[lidx][0])[:band_size]
+            states = {lidx: states[lidx] for lidx in kept}
+            alignments[tidx] = states
+
+        # Transcript lines that failed to identify any text can only be skipped, and cost the same for every alignment
+        skip_cost = 0 if len(transcript[tidx]) == 0 else ALIGN_UNKNOWN_COST
+        for lidx, (cost, _, _, _) in states.items():
+            add_alignment(alignments[tidx + 1], lidx, cost + skip_cost, tidx, lidx, None)
+        if len(transcript[tidx]) == 0:
+            continue
+
+        for candidate in get_band(best_lidx, tidx, len(lines), transcript, args, index):
+            # Cheapest way to arrive at the candidate: continuing from the previous line, retaking it, or jumping to it
+            previous = min(
+                (states[candidate - 1][0], candidate - 1) if candidate - 1 in states else (float("inf"), None),
+                (states[candidate][0] + ALIGN_RETAKE_COST, candidate) if candidate in states else (float("inf"), None),
+                (best_cost + ALIGN_JUMP_COST, best_lidx))
+            threshold = get_match_threshold_by_length(len(lines[candidate]), args)
+
+            # Consecutive transcript lines are merged for as long as each of them is a substring of the script line
+            # and the similarity improves, same as in the greedy matching
+            end = tidx
+            while end < len(transcript) and end - tidx < args.align_max_merge:
+                if end > tidx and (len(transcript[end]) == 0
+                                   or scores.similarity(candidate, tidx, end - 1) >= scores.similarity(candidate, tidx, end)
+                                   or not scores.substring(candidate, tidx, args.substring_threshold)
+                                   or not scores.substring(candidate, end, args.substring_threshold)):
+                    break
+                if scores.perfect_match(candidate, tidx, end, threshold):
+                    match_cost = (1 - scores.similarity(candidate, tidx, end)) * ALIGN_SIMILARITY_COST
+                    add_alignment(alignments[end + 1], candidate, previous[0] + match_cost, tidx, previous[1], candidate)
+                end += 1
+
+    # Follows the cheapest complete alignment back to the start
+    steps = []
+    tidx = len(transcript)
+    lidx = min(alignments[tidx], key=lambda lidx: alignments[tidx][lidx][0])
+    while tidx > 0:
+        (_, previous_tidx, previous_lidx, step) = alignments[tidx][lidx]
+        steps.append((previous_tidx, tidx, step))
+        (tidx, lidx) = (previous_tidx, previous_lidx)
+    steps.reverse()
+
+    final_timestamps = []
+    filenames = []
+    id_dictionary = {}
+    for (start, end, step) in steps:
+        final_timestamps.append([timestamps[start][0], timestamps[end - 1][1]])
+        if step is not None:
+            update_instance_count(id_dictionary, step, ids)
+            filenames.append(f"{ids[step]}__take_{id_dictionary[ids[step]]}.wav")
+            pass_on_clip(on_clip, final_timestamps, filenames)
+            log.write(TRACE_DECISIONS, "Aligned: \nT: {}\nL: {}\n", scores.sentence(start, end - 1), lines[step])
+        elif len(transcript[start]) == 0:
+            filenames.append(f"UNIDENTIFIED.wav")
+            pass_on_clip(on_clip, final_timestamps, filenames)
+            log.write(TRACE_DECISIONS, "No text transcribed, saving as UNIDENTIFIED.wav\n")
+        else:
+            unknown_name = get_unknown_name(transcript[start], args.max_random_name_length)
+            filenames.append(f"{unknown_name}.wav")
+            pass_on_clip(on_clip, final_timestamps, filenames)
+            log.write(TRACE_DECISIONS, "No alignment found for: {}\nSaving as {}.wav\n", transcript[start], unknown_name)
+        log.write(TRACE_STEPS, "\n")
+
+    return (final_timestamps, filenames, id_dictionary)
+
+# Keeps the alignment if it is the cheapest one found so far that ends on the script line lidx
+def add_alignment(states, lidx, cost, previous_tidx, previous_lidx, step):
+    if lidx not in states or cost < states[lidx][0]:
+        states[lidx] = (cost, previous_tidx, previous_lidx, step)
+
+# Amount of samples y[start:end] holds, found without slicing, which would read the clip from the file with seek extraction
+def get_slice_length(y, start, end):
+    return max(0, min(end, len(y)) - min(start, len(y)))
+
+# Finds the first and last sample of every clip that is outside of the (-threshold, threshold) range, or None
+# for clips where no sample is. Clips are processed in batches of up to batch_samples samples, with every
+# batch masked and searched at once. Samples are compared as float64, same as the former sample by sample loop
+def find_audible_samples(y, timestamps, threshold, batch_samples=1 << 24):
+    first_samples = []
+    last_samples = []
+    batch_start = 0
+    while batch_start < len(timestamps):
+        # Clips are added to the batch until it is full, and each batch holds at least one clip
+        batch_end = batch_start + 1
+        batch_length = get_slice_length(y, *timestamps[batch_start])
+        while batch_end < len(timestamps):
+            clip_length = get_slice_length(y, *timestamps[batch_end])
+            if batch_length + clip_length > batch_samples:
+                break
+            batch_length += clip_length
+            batch_end += 1
+
+        clips = [y[start:end] for start, end in timestamps[batch_start:batch_end]]
+        lengths = np.array([len(clip) for clip in clips], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        batch = np.concatenate(clips).astype(np.float64)
+        audible = np.flatnonzero(~((batch < threshold) & (batch > -1 * threshold)))
+
+        # First audible sample at or after the start of each clip, and the last one before its end
+        first = np.searchsorted(audible, offsets)
+        last = np.searchsorted(audible, offsets + lengths) - 1
+        for i in range(len(clips)):
+            if first[i] < len(audible) and audible[first[i]] < offsets[i] + lengths[i]:
+                first_samples.append(int(audible[first[i]] - offsets[i]))
+                last_samples.append(int(audible[last[i]] - offsets[i]))
             else:
-                # Unknown's filename contains the transcribed value
-                unknown_name = "UNKNOWN__" + transcript[tidx].replace(" ", "_")
+                first_samples.append(None)
+                last_samples.append(None)
+
+        batch_start = batch_end
+    return (first_samples, last_samples)
+
+# Finds the first and last audible sample of every clip from the frame loudness saved by AudioCutter, in the same form
+# as find_audible_samples. A frame is audible once its loudness reaches the threshold, and stands for the sample at
+# its center, so the results are only as exact as the hop length between frames
+def find_audible_frames(envelope, timestamps, threshold, hop_length):
+    audible = np.flatnonzero(np.asarray(envelope) >= threshold)
+    starts = np.array([start for start, _ in timestamps], dtype=np.int64)
+    ends = np.array([end for _, end in timestamps], dtype=np.int64)
+
+    # Frames centered within each clip, and the first and last audible one among them
+    first_frames = -(-starts // hop_length)
+    end_frames = -(-ends // hop_length)
+    first = np.searchsorted(audible, first_frames)
+    last = np.searchsorted(audible, end_frames) - 1
+
+    first_samples = []
+    last_samples = []
+    for i in range(len(timestamps)):
+        if first[i] < len(audible) and audible[first[i]] < end_frames[i]:
+            first_samples.append(int(audible[first[i]] * hop_length - starts[i]))
+            last_samples.append(int(audible[last[i]] * hop_length - starts[i]))
+        else:
+            first_samples.append(None)
+            last_samples.append(None)
+    return (first_samples, last_samples)
+
+# Finds the first sample of every clip reaching the start trim threshold, and the last one reaching the end trim threshold.
+# When the frame loudness is given, the clips are checked by it instead of by their samples
+def find_clip_edges(y, final_timestamps, args, envelope=None):
+    if envelope is not None:
+        (first_samples, _) = find_audible_frames(envelope, final_timestamps, args.start_trim_threshold, args.hop_length)
+        (_, last_samples) = find_audible_frames(envelope, final_timestamps, args.end_trim_threshold, args.hop_length)
+    else:
+        (first_samples, _) = find_audible_samples(y, final_timestamps, args.start_trim_threshold)
+        (_, last_samples) = find_audible_samples(y, final_timestamps, args.end_trim_threshold)
+    return (first_samples, last_samples)
+
+def get_trimmed_timestamps(y, final_timestamps, args, sr, envelope=None):
+    (first_samples, last_samples) = find_clip_edges(y, final_timestamps, args, envelope)
+    return trim_timestamps(final_timestamps, first_samples, last_samples, args, sr, len(y))
+
+# Trims the silence from the start and end of every clip, then extends the cuts by the trim buffers.
+# Clips where no sample reaches a threshold are handled the same way as they were by the former
+# sample by sample search, which counted the whole clip as silence. Only needs the length of the audio,
+# so the buffers can be changed without reading the samples again
+def trim_timestamps(final_timestamps, first_samples, last_samples, args, sr, length):
+    # A defined amount of additional time is used as a buffer to not cut too mutch
+    start_trim_buffer = int(args.start_trim_buffer * sr)
+    end_trim_buffer = int(args.end_trim_buffer * sr)
+
+    trimmed_timestamps = []
+    for (start, end), first_sample, last_sample in zip(final_timestamps, first_samples, last_samples):
+        clip_length = max(0, min(end, length) - min(start, length))
+
+        # Count of silent samples cut from the start, the whole clip if it has no audible samples
+        if first_sample is not None:
+            i_start = first_sample
+            start += i_start
+        else:
+            i_start = clip_length
 
-                # Trims the name in case the transcripted text is too long for a filename
-                if len(unknown_name) > max_random_name_length:
-                    unknown_name = unknown_name[:max_random_name_length]
+        # Buffer extends the timestamp for cutting
+        if start - start_trim_buffer < 0:
+            start = 0
+        else:
+            start -= start_trim_buffer
 
-                clip_start = timestamps[tidx]
-                clip_end = timestamps[tidx]
-                final_timestamps.append([clip_start[0], clip_end[1]])
+        # Repeated for end of audio clip
+        if last_sample is not None:
+            i_end = clip_length - 1 - last_sample
+            end -= i_end
+        else:
+            i_end = clip_length
+            end -= i_end
+            start += i_start
 
-                filenames.append(f"{unknown_name}.wav")
+        if i_end + end_trim_buffer > length - 1:
+            end = length - 1
+        else:
+            end += end_trim_buffer
+
+        trimmed_timestamps.append((start, end))
+    return trimmed_timestamps
+
+# Session of a sweep shared with the worker processes replaying its configurations, along with the scores
+# already computed by the first configuration
+sweep_session = None
+
+def init_sweep_worker(session):
+    global sweep_session
+    sweep_session = session
+
+# Matches the transcript with the arguments of a single configuration of the sweep, reporting its results
+def replay_configuration(configuration):
+    session = sweep_session
+    args = argparse.Namespace(**vars(session["args"]))
+    for name, value in configuration.items():
+        setattr(args, name, value)
+    scores = session["scores"]
+    index = session["index"] if args.lookup == "index" else None
+    match_function = match_transcript_aligned if args.matcher == "align" else match_transcript
+
+    computed = scores.misses
+    start_time = time.perf_counter()
+    (_, filenames, id_dictionary) = match_function(session["lines"], session["ids"], session["transcript"], session["timestamps"],
+                                                   args, scores, index, TraceLog(None, TRACE_OFF))
+    unknown = sum(1 for filename in filenames if filename.startswith("UNKNOWN"))
+    unidentified = sum(1 for filename in filenames if filename.startswith("UNIDENTIFIED"))
+    return {
+        "configuration": configuration,
+        "matched": len(filenames) - unknown - unidentified,
+        "unknown": unknown,
+        "unidentified": unidentified,
+        "not_found": [id for id in session["ids"] if id not in id_dictionary],
+        "seconds": time.perf_counter() - start_time,
+        "scores_computed": scores.misses - computed,
+    }
+
+# Matches the transcript with every combination of the match arguments in the sweep grid, a JSON object of
+# {argument: [values]}. The first configuration is matched here, and the scores it computed are handed to the
+# worker processes replaying the others, so only the pairs the first one didn't reach are scored again.
+# The results of every configuration are printed and saved into SweepReport.json
+def sweep_matching(args, directory, lines, ids, transcript, timestamps, matrix):
+    with open(args.sweep_grid or os.path.join(directory, "SweepGrid.json"), 'r') as file:
+        grid = json.load(file)
+    for name in grid:
+        if name not in MATCH_ARGS:
+            raise ValueError(f"Only the match arguments can be swept, not {name}: {', '.join(MATCH_ARGS)}")
+    configurations = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+    substring_threshold = min([args.substring_threshold] + grid.get("substring_threshold", []))
+    session = {
+        "args": args,
+        "lines": lines,
+        "ids": ids,
+        "transcript": transcript,
+        "timestamps": timestamps,
+        "scores": SweepScores(lines, transcript, args.similarity_cache_size, matrix, substring_threshold),
+        "index": ScriptIndex(lines) if args.lookup == "index" or "index" in grid.get("lookup", []) else None,
+    }
+
+    start_time = time.perf_counter()
+    init_sweep_worker(session)
+    reports = [replay_configuration(configurations[0])]
+    workers = min(args.workers or os.cpu_count(), len(configurations) - 1)
+    if workers <= 1:
+        reports += [replay_configuration(configuration) for configuration in configurations[1:]]
+    else:
+        with multiprocessing.Pool(workers, initializer=init_sweep_worker, initargs=(session,)) as pool:
+            reports += pool.map(replay_configuration, configurations[1:])
 
-                # Resets lidx to the original value before lookup
-                lidx = lidx_saved
-                # Increments tidx to bypass the unknown line
-                tidx += 1
-                backtrack = 0
-                forwardtrack = 0
-                log.writelines(f"No match found after forward and backtrack, saving as {unknown_name}.wav\n")
+    for report in reports:
+        configuration = " ".join(f"{name}={value}" for name, value in report["configuration"].items())
+        print(f"{configuration}: {report['matched']} matched, {report['unknown']} unknown, {report['unidentified']} unidentified, "
+              f"{len(report['not_found'])} not found, {report['seconds']:.2f}s, {report['scores_computed']} scores computed")
+    print(f"Swept {len(configurations)} configurations in {time.perf_counter() - start_time:.2f}s")
+
+    with open(os.path.join(directory, "SweepReport.json"), 'w', encoding="utf-8") as file:
+        json.dump(reports, file, indent=1)
+
+def main(args):
+    Instrumentation.start_run("ClipMaker")
+
+    # Definitions for filepaths used in the script
+    directory = args.workspace or get_dir()
+    transcript_path = os.path.join(directory, "Transcript.txt")
+    timestamps_path = os.path.join(directory, "Timestamps.txt")
+
+    # Read the outputs of the transcript and the audio segment timestamps
+    with open(transcript_path, 'r', encoding="utf8") as file:
+        transcript = file.readlines()
+    with Instrumentation.stage("normalize"):
+        transcript = [string.strip() for string in transcript]
+        transcript = [normalize_string(string) for string in transcript]
 
-        log.writelines("\n")    
+    with open(timestamps_path, 'r') as file:
+        timestamps = file.readlines()
+    timestamps = [string.strip() for string in timestamps]
+    timestamps = [[int(num) for num in string.split(',')] for string in timestamps]
 
-    log.close()
+    make_clips(args, directory, transcript, timestamps)
+    Instrumentation.save_report(directory)
+
+# Matches the normalized transcript against the dialogue script and saves the identified clips. The decoded audio
+# can be passed in by a caller that already holds it, otherwise it is taken from the cache or decoded from the file
+def make_clips(args, directory, transcript, timestamps, y=None):
+    audio_path = args.audio
+    dialogue_path = args.dialogue
+    final_directory = os.path.join(directory, "Clips")
+    not_found_path = os.path.join(directory, "NotFound.txt")
+
+    # Gets the dialogue lines and the filenames that they need to have (ids)
+    (lines, ids) = read_dialogue_file(dialogue_path)
+    # Original values are saved for the purpose of printing out original line contents in the NotFound.txt file
+    not_normalized = lines    
+    with Instrumentation.stage("normalize"):
+        lines = [normalize_string(string) for string in lines]
+
+    # Script lines that are normalized to empty strings can't be found via the algorithm and will be saved here. 
+    empty_line_ids = []
+    to_remove = []
+    for i in range(len(lines)):
+        if not lines[i]:
+            empty_line_ids.append(ids[i] + "   " + not_normalized[i] + "\n")
+            to_remove.append(i)
+
+    for i in reversed(to_remove):
+        del ids[i]
+        del lines[i]
+        del not_normalized[i]
+    
+    # Stages of a former run are skipped for as long as their inputs stay the same, starting with the matching.
+    # Traced runs always match again, as the trace is written while matching
+    state = ClipMakerState(directory)
+    match_fingerprint = get_stage_fingerprint(lines, ids, transcript, timestamps, {name: getattr(args, name) for name in MATCH_ARGS})
+    matches = state.get("match", match_fingerprint) if args.mode == "clips" and not args.trace else None
+
+    # The similarity matrix is reused between runs for as long as the normalized script and transcript stay the same
+    matrix = None
+    if args.mode == "matrix" or (args.use_similarity_matrix and matches is None):
+        matrix = load_similarity_matrix(directory, lines, transcript)
+        if matrix is None:
+            matrix_start = time.perf_counter()
+            matrix = build_similarity_matrix(lines, transcript, args.workers or os.cpu_count())
+            save_similarity_matrix(directory, matrix, lines, transcript)
+            print(f"Computed {matrix.shape[0]}x{matrix.shape[1]} similarity matrix in {time.perf_counter() - matrix_start:.2f}s")
+
+    # Matrix mode only saves the similarity ratios for inspecting and tuning the thresholds
+    if args.mode == "matrix":
+        np.save(os.path.join(directory, "SimilarityRatios.npy"), get_similarity_ratios(matrix, lines, transcript).astype(np.float32))
+        return
+
+    # Sweep mode only reports the results of every configuration of the match arguments, without saving clips
+    if args.mode == "sweep":
+        sweep_matching(args, directory, lines, ids, transcript, timestamps, matrix)
+        return
+
+    # Clips of the former run are kept, and only rewritten when they come out differently
+    os.makedirs(final_directory, exist_ok=True)
+
+    # Processing audiofile to get stream and sample rate. Audio decoded by a former run is memory-mapped from the cache,
+    # while seek extraction reads only the audio of the clips straight from the file.
+    # The audio is only opened once a clip needs it, so reruns that don't change any clip don't read it at all.
+    # With a sample rate of 0 the clips are cut from the audio at the rate of the file, without resampling it
+    sr = resolve_sample_rate(audio_path, args.sample_rate)
+    def get_audio():
+        nonlocal y, sr
+        if y is None and args.extraction == "seek":
+            y = SeekableAudio(audio_path, sr)
+        if y is None and args.audio_cache:
+            y = load_audio_cache(directory, audio_path, sr)
+        if y is None:
+            with Instrumentation.stage("load"):
+                y, sr = load_audio(audio_path, sr)
+                # When AudioCutter analysed the audio at another rate, the cache is left holding its audio
+                if args.audio_cache and (args.analysis_rate or sr) == sr:
+                    save_audio_cache(directory, y, audio_path, sr)
+        return y
+
+    # Envelope trimming runs off the frame loudness saved by AudioCutter, falling back to the samples if there is none
+    envelope = None
+    if args.trim == "envelope":
+        envelope = load_envelope(directory, audio_path, sr, args.frame_length, args.hop_length)
+        if envelope is None:
+            print("No frame loudness saved by AudioCutter for this audio file, trimming by the samples instead")
+        else:
+            envelope = envelope[0]
+
+    # Audible edges of every matched segment, by its timestamps, reused for as long as the audio and trim thresholds stay the same.
+    # Clips are identified by their trimmed timestamps, and their files by their size and modification time
+    audio_key = get_audio_key(audio_path, sr)
+    edges_fingerprint = get_stage_fingerprint(audio_key, args.extraction, envelope is not None, args.start_trim_threshold,
+                                              args.end_trim_threshold, args.frame_length, args.hop_length)
+    edges = state.get("edges", edges_fingerprint) or {"length": None, "segments": {}}
+    clips_fingerprint = get_stage_fingerprint(audio_key, args.extraction, args.export_format)
+    saved_clips = state.get("clips", clips_fingerprint) or {}
+    clips = {}
+
+    # Clips are forgotten until the run finishes, so the ones rewritten by a run that stopped half way aren't taken as current
+    state.set("clips", clips_fingerprint, {})
+    state.save()
+
+    exporter = ClipExporter(final_directory, args.export_format, args.export_workers, sr)
+
+    # Trims the silence from the edges of a matched clip and hands it over to be saved, titled with its trimmed timestamp,
+    # unless the same clip was already saved by a former run
+    def export_clip(timestamp, filename):
+        segment = f"{timestamp[0]},{timestamp[1]}"
+        if segment not in edges["segments"]:
+            audio = get_audio()
+            with Instrumentation.stage("trim"):
+                (first_samples, last_samples) = find_clip_edges(audio, [timestamp], args, envelope)
+            edges["segments"][segment] = [first_samples[0], last_samples[0]]
+        if edges["length"] is None:
+            edges["length"] = len(get_audio())
+        (first_sample, last_sample) = edges["segments"][segment]
+        (start, end) = trim_timestamps([timestamp], [first_sample], [last_sample], args, sr, edges["length"])[0]
+
+        clip_filename = os.path.splitext(f"{get_timestamp(start, sr)}__{filename}")[0] + exporter.extension
+        saved_clip = saved_clips.get(clip_filename)
+        if saved_clip is not None and saved_clip[:2] == [start, end] \
+                and saved_clip[2:] == get_file_stat(os.path.join(final_directory, clip_filename)):
+            clips[clip_filename] = saved_clip
+            return
+        clips[clip_filename] = [int(start), int(end)]
+        audio = get_audio()
+        with Instrumentation.stage("export"):
+            exporter.write(clip_filename, audio[start:end])
+
+    try:
+        if matches is None:
+            # log.txt will store the execution steps of the algorithm and thus help debugging, when they are traced
+            log = TraceLog(os.path.join(directory, "log.txt"), args.trace)
+            scores = SimilarityCache(lines, transcript, args.similarity_cache_size, matrix)
+            index = ScriptIndex(lines) if args.lookup == "index" else None
+            match_function = match_transcript_aligned if args.matcher == "align" else match_transcript
+            try:
+                with Instrumentation.stage("match"):
+                    (final_timestamps, filenames, id_dictionary) = match_function(lines, ids, transcript, timestamps, args, scores, index, log, export_clip)
+            finally:
+                log.close()
+            print(scores.stats())
+            Instrumentation.count("similarity_calls", scores.hits + scores.misses)
+            Instrumentation.count("similarity_cache_hits", scores.hits)
+            state.set("match", match_fingerprint, {"timestamps": final_timestamps, "filenames": filenames, "takes": id_dictionary})
+        else:
+            print("Matching skipped, the script, transcript and match arguments are the same as in the last run")
+            (final_timestamps, filenames, id_dictionary) = (matches["timestamps"], matches["filenames"], matches["takes"])
+            for timestamp, filename in zip(final_timestamps, filenames):
+                export_clip(timestamp, filename)
+    finally:
+        with Instrumentation.stage("export"):
+            exporter.close()
+
+    # Files of clips that are no longer made are removed, and the saved ones are identified by their new size and modification time
+    removed = 0
+    for clip_filename in os.listdir(final_directory):
+        if clip_filename not in clips:
+            os.remove(os.path.join(final_directory, clip_filename))
+            removed += 1
+    for clip_filename, clip in clips.items():
+        if len(clip) == 2:
+            clip.extend(get_file_stat(os.path.join(final_directory, clip_filename)))
+    print(exporter.stats())
+    print(f"Clips: {exporter.files} saved, {len(clips) - exporter.files} unchanged, {removed} removed")
+    Instrumentation.count("clips_saved", exporter.files)
+    Instrumentation.count("clips_unchanged", len(clips) - exporter.files)
+    Instrumentation.count("clips_removed", removed)
+    Instrumentation.count("bytes_written", exporter.bytes)
+
+    state.set("edges", edges_fingerprint, edges)
+    state.set("clips", clips_fingerprint, clips)
+    state.save()
+    save_clip_manifest(directory, list(clips))
 
     not_found_ids = []
 
@@ -408,68 +1160,47 @@ def main(args):
         for id_and_line in empty_line_ids:
             file.write(id_and_line)
 
-    # Creating segment data from timestamps by which the identified audio clips will be saved
-    final_segments = []
-    for i, (start, end) in enumerate(final_timestamps):
-        # Audio is trimmed to remove silence at the start and end of clip
-        start_trim_threshold = args.start_trim_threshold
-        end_trim_threshold = args.end_trim_threshold
-
-        # A defined amount of additional time is used as a buffer to not cut too mutch
-        start_trim_buffer = args.start_trim_buffer * sr
-        end_trim_buffer = args.end_trim_buffer * sr
-
-        clip_audio = y[start:end]
-        
-        # Cutting frames one by one until one reaching threshold value is found
-        i_start = 0
-        while clip_audio[i_start] < start_trim_threshold and clip_audio[i_start] > -1 * start_trim_threshold:
-            start += 1
-            i_start += 1
-            
-            # This if handles exceptions where an audio segment doesn't have detectable audio
-            if i_start > len(clip_audio) - 1:
-                start -= i_start
-                break
-
-        # Buffer extends the timestamp for cutting
-        if start - int(start_trim_buffer) < 0:
-            start = 0
-        else:
-            start -= int(start_trim_buffer)
-
-        # Audio clip processed in reverse for faster array access
-        reversed_clip_audio = clip_audio[::-1]
-
-        # Repeated for end of audio clip, logic stays the same
-        i_end = 0
-        while reversed_clip_audio[i_end] < end_trim_threshold and reversed_clip_audio[i_end] > -1 * end_trim_threshold:
-            end -= 1
-            i_end += 1
-            if i_end > len(reversed_clip_audio) - 1:
-                start += i_start
-                break
-        
-        if i_end + int(end_trim_buffer) > len(y) - 1:
-            end = len(y) - 1
-        else:
-            end += int(end_trim_buffer)
-
-        trimmed_audio = y[start:end]
-        final_segments.append(trimmed_audio)
-        trimmed_timestamp = get_timestamp(start, sr)
-        filenames[i] = f"{trimmed_timestamp}__{filenames[i]}"
-
-    # Saving final audio clip
-    for i, segment in enumerate(final_segments):
-        clip_path = os.path.join(final_directory, filenames[i])
-        sf.write(clip_path, segment, sr, format='wav', subtype = 'PCM_32')
-
 # Main to extract the .json file as input variables
 if __name__ == "__main__":
-
-    with open(os.path.join(get_dir(), "args.json"), 'r') as file:
-        args = json.load(file)
-    args = argparse.Namespace(**args)
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description="Script to cut up the audio file into clips matching the dialogue script")
+
+    # Options for a single run of the script
+    parser.add_argument("--mode", choices=["clips", "matrix", "sweep"], default="clips")
+    parser.add_argument("--sweep_grid", default=None)
+    parser.add_argument("--use_similarity_matrix", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--trace", type=int, choices=[0, 1, 2], default=0)
+
+    # Defaults for parameters that might be missing from an args.json made by an older AudioCutter
+    parser.add_argument("--similarity_cache_size", type=int, default=1000000)
+    parser.add_argument("--lookup", choices=["window", "index"], default="window")
+    parser.add_argument("--lookup_candidates", type=int, default=10)
+    parser.add_argument("--matcher", choices=["greedy", "align"], default="greedy")
+    parser.add_argument("--align_max_merge", type=int, default=4)
+    parser.add_argument("--audio_cache", type=int, default=1)
+    parser.add_argument("--analysis_rate", type=int, default=0)
+    parser.add_argument("--export_format", choices=list(EXPORT_FORMATS), default="PCM_32")
+    parser.add_argument("--export_workers", type=int, default=4)
+    parser.add_argument("--extraction", choices=["memory", "seek"], default="memory")
+    parser.add_argument("--trim", choices=["samples", "envelope"], default="samples")
+
+    # The workspace holding args.json and the files of the former scripts, next to the script unless given.
+    # It is found before the other arguments, as their saved values are read from there
+    workspace_parser = argparse.ArgumentParser(add_help=False)
+    workspace_parser.add_argument("--workspace", default=None)
+    workspace = workspace_parser.parse_known_args()[0].workspace or get_dir()
+    parser.add_argument("--workspace", default=workspace)
+
+    # Values saved by AudioCutter take precedence over the defaults, and command line values over both
+    with open(os.path.join(workspace, "args.json"), 'r') as file:
+        saved_args = json.load(file)
+    for name, value in saved_args.items():
+        if parser.get_default(name) is None:
+            parser.add_argument(f"--{name}", type=type(value) if value is not None else str)
+    parser.set_defaults(**saved_args)
+    parser.set_defaults(workspace=workspace)
+    args = parser.parse_args()
 
     main(args)
\ No newline at end of file
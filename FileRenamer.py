@@ -1,11 +1,13 @@
 import os
-import editdistance
-import librosa
-import soundfile as sf
 import sys
 import shutil
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
+import Instrumentation
+
+# Request code of the Linux ioctl cloning a whole file into another, the same as FICLONE in linux/fs.h
+FICLONE = 0x40049409
 
 def get_filenames(folder_path):
     # Check if the provided path is a directory
@@ -15,11 +17,11 @@ def get_filenames(folder_path):
 
     # Get list of files in the directory
     files = os.listdir(folder_path)
-    
-    # Filter out directories, if any, and filenames containing 'UNKNOWN' or 'UNIDENTIFIED'
-    files = [file for file in files if os.path.isfile(os.path.join(folder_path, file)) and ('UNKNOWN' not in file) and ('UNIDENTIFIED' not in file)]
 
-    return files
+    # Filter out directories, if any
+    files = [file for file in files if os.path.isfile(os.path.join(folder_path, file))]
+
+    return sorted(files)
 
 
 def split_string(input_str):
@@ -27,12 +29,12 @@ def split_string(input_str):
     first_index = input_str.find('__')
     # Find the index of the last '__'
     last_index = input_str.rfind('__')
-    
+
     # Extract string1, string2, and string3
     string1 = input_str[:first_index] if first_index != -1 else input_str
     string2 = input_str[first_index + 2:last_index] if first_index != -1 and last_index != -1 else ''
     string3 = input_str[last_index + 2:] if last_index != -1 else ''
-    
+
     return [string1, string2, string3]
 
 def get_dir():
@@ -42,27 +44,137 @@ def get_dir():
         dir = os.path.dirname(os.path.abspath(__file__))
     return dir
 
-def copy_dir(source, new):
-    shutil.copytree(source, new)
+# Reads the clip filenames in the order ClipMaker made them from the manifest it saves next to the Clips folder.
+# Clips made before there was a manifest are listed from the folder, in the order of their names
+def read_clip_manifest(directory, clip_directory):
+    manifest_path = os.path.join(directory, "ClipManifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding="utf-8") as file:
+            return json.load(file)["clips"]
+    print("No clip manifest saved by ClipMaker, listing the clips from the folder instead")
+    return get_filenames(clip_directory)
+
+# Saves the new names into the manifest once the clips are renamed in place, so running again finds them
+def save_clip_manifest(directory, clip_filenames):
+    manifest_path = os.path.join(directory, "ClipManifest.json")
+    temporary_path = manifest_path + ".tmp"
+    with open(temporary_path, 'w', encoding="utf-8") as file:
+        json.dump({"folder": "Clips", "clips": clip_filenames}, file)
+    os.replace(temporary_path, manifest_path)
+
+# Pairs every clip with its new name, in which every take of a line has the timestamp of the first take of that line.
+# Unknown and unidentified clips keep their names
+def plan_renames(filenames):
+    found_ids = {}
+    plan = []
+    for filename in filenames:
+        if 'UNKNOWN' in filename or 'UNIDENTIFIED' in filename:
+            plan.append((filename, filename))
+            continue
+        name_info = split_string(filename)
+        if name_info[1] not in found_ids:
+            found_ids[name_info[1]] = name_info[0]
+        else:
+            name_info[0] = found_ids[name_info[1]]
+        plan.append((filename, f"{name_info[0]}__{name_info[1]}__{name_info[2]}"))
+    return plan
+
+def reflink_file(source, target):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("Reflinks are not supported on this system")
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+
+# Places a clip into the ordered folder without copying its audio where the file system allows it. A hard link is the same
+# file as the clip, while a reflink (Btrfs, XFS) shares its data until either file is changed. The clip is copied instead
+# where neither is supported, such as between drives, returning how it was placed
+def place_file(source, target, method):
+    try:
+        if method == "link":
+            os.link(source, target)
+            return "linked"
+        if method == "reflink":
+            reflink_file(source, target)
+            return "reflinked"
+    except OSError:
+        pass
+    shutil.copy2(source, target)
+    return "copied"
+
+# Fills the ordered folder anew with every clip under its new name, placing the files over a pool of threads
+def place_files(clip_directory, ordered_directory, plan, method, workers):
+    if os.path.exists(ordered_directory):
+        shutil.rmtree(ordered_directory)
+    os.makedirs(ordered_directory)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda names: place_file(os.path.join(clip_directory, names[0]),
+                                                      os.path.join(ordered_directory, names[1]), method), plan))
+
+# Renames the clips inside their own folder as a single plan. Every name is checked before the first rename, and should any
+# of the renames fail, the ones done are undone, so the folder is left either fully renamed or as it was
+def rename_in_place(clip_directory, plan, workers):
+    plan = [(old_filename, new_filename) for old_filename, new_filename in plan if old_filename != new_filename]
+    new_filenames = [new_filename for _, new_filename in plan]
+    if len(set(new_filenames)) != len(new_filenames):
+        raise FileExistsError("More than one clip would be renamed to the same name")
+    for old_filename, new_filename in plan:
+        if not os.path.isfile(os.path.join(clip_directory, old_filename)):
+            raise FileNotFoundError(f"Clip {old_filename} of the manifest is missing from {clip_directory}")
+        if os.path.exists(os.path.join(clip_directory, new_filename)):
+            raise FileExistsError(f"Renaming {old_filename} would overwrite {new_filename}")
+
+    def rename(names):
+        os.rename(os.path.join(clip_directory, names[0]), os.path.join(clip_directory, names[1]))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(pool.submit(rename, names), names) for names in plan]
+    done = [names for future, names in futures if future.exception() is None]
+    errors = [future.exception() for future, _ in futures if future.exception() is not None]
+    if errors:
+        for old_filename, new_filename in done:
+            os.rename(os.path.join(clip_directory, new_filename), os.path.join(clip_directory, old_filename))
+        raise errors[0]
 
-found_ids = {}
-dirpath_old = get_dir() + "\\Clips\\"
-dirpath_new = get_dir() + "\\ClipsOrdered\\"
+def main(args):
+    Instrumentation.start_run("FileRenamer")
+    directory = args.workspace or get_dir()
+    clip_directory = os.path.join(directory, "Clips")
+    ordered_directory = os.path.join(directory, "ClipsOrdered")
 
-if os.path.exists(dirpath_new):
-    shutil.rmtree(dirpath_new)
-shutil.copytree(dirpath_old, dirpath_new)
+    with Instrumentation.stage("plan"):
+        plan = plan_renames(read_clip_manifest(directory, clip_directory))
+    renamed = sum(1 for old_filename, new_filename in plan if old_filename != new_filename)
 
-old_filenames = (get_filenames(dirpath_new))
-new_filenames = []
+    # Dry runs only print the new names, leaving the files as they are
+    if args.dry_run:
+        for old_filename, new_filename in plan:
+            if old_filename != new_filename:
+                print(f"{old_filename} -> {new_filename}")
+        print(f"{renamed} of {len(plan)} clips would be renamed")
+        return
 
-for filename in old_filenames:
-    name_info = split_string(filename)
-    if name_info[1] not in found_ids:
-        found_ids[name_info[1]] = name_info[0]
+    workers = args.workers or os.cpu_count()
+    if args.method == "rename":
+        with Instrumentation.stage("rename"):
+            rename_in_place(clip_directory, plan, workers)
+            save_clip_manifest(directory, [new_filename for _, new_filename in plan])
+        print(f"Renamed {renamed} of {len(plan)} clips in {clip_directory}")
     else:
-        name_info[0] = found_ids[name_info[1]]
-    new_filenames.append(f"{name_info[0]}__{name_info[1]}__{name_info[2]}")
+        with Instrumentation.stage(args.method):
+            placed = place_files(clip_directory, ordered_directory, plan, args.method, workers)
+        counts = {result: placed.count(result) for result in sorted(set(placed))}
+        for result, count in counts.items():
+            Instrumentation.count(f"files_{result}", count)
+        print(f"Placed {len(placed)} clips into {ordered_directory}: " + ", ".join(f"{count} {result}" for result, count in counts.items()))
+    Instrumentation.count("files_renamed", renamed)
+    Instrumentation.save_report(directory)
 
-for old_filename, new_filename in zip(old_filenames, new_filenames):
-    os.rename(dirpath_new + old_filename, dirpath_new + new_filename)
\ No newline at end of file
+# Only renames when run, so the other scripts and the benchmarks can import it
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script to order the clips of ClipMaker by the first take of every line")
+    parser.add_argument("--workspace", default=None)
+    parser.add_argument("--method", choices=["link", "reflink", "copy", "rename"], default="link")
+    parser.add_argument("--dry_run", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# resource is only available on Unix, elsewhere the peak memory use isn't measured
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Peak memory use of this process so far in megabytes, or None where it can't be measured
+def get_peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+# Measurements of a single run of a script: the wall and CPU time of every stage along with the peak memory use of the
+# process by the time it finished, and counters of the work done. Stages that run more than once add up.
+# Stages started within another stage on the same thread count towards both, and the time of every stage is also
+# given net of the stages nested in it. CPU time is measured for the whole process, so stages running at the same
+# time on other threads count each other's CPU time
+class RunReport:
+    def __init__(self, script):
+        self.script = script
+        self.started = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        # Wall and CPU time of the stages nested in each of the stages running on the thread, innermost last
+        self.nested = threading.local()
+
+    @contextmanager
+    def stage(self, name):
+        if not hasattr(self.nested, "stack"):
+            self.nested.stack = []
+        self.nested.stack.append([0, 0])
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.process_time() - start_cpu
+            (nested_wall, nested_cpu) = self.nested.stack.pop()
+            if self.nested.stack:
+                self.nested.stack[-1][0] += wall
+                self.nested.stack[-1][1] += cpu
+            with self.lock:
+                measured = self.stages.setdefault(name, {"calls": 0, "wall_seconds": 0, "cpu_seconds": 0,
+                                                         "self_wall_seconds": 0, "self_cpu_seconds": 0})
+                measured["calls"] += 1
+                measured["wall_seconds"] += wall
+                measured["cpu_seconds"] += cpu
+                measured["self_wall_seconds"] += wall - nested_wall
+                measured["self_cpu_seconds"] += cpu - nested_cpu
+                measured["peak_rss_mb"] = get_peak_rss()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get_summary(self):
+        return {
+            "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+            "wall_seconds": time.perf_counter() - self.start_wall,
+            "cpu_seconds": time.process_time() - self.start_cpu,
+            "peak_rss_mb": get_peak_rss(),
+            "stages": self.stages,
+            "counters": self.counters,
+        }
+
+    # Saves the report into run_report.json in the given folder, which keeps the report of the last run of every script.
+    # The file is written to a temporary file first, so a run that stops while saving never corrupts it
+    def save(self, directory):
+        path = os.path.join(directory, "run_report.json")
+        reports = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding="utf-8") as file:
+                reports = json.load(file)
+        reports[self.script] = self.get_summary()
+
+        temporary_path = path + ".tmp"
+        with open(temporary_path, 'w', encoding="utf-8") as file:
+            json.dump(reports, file, indent=4)
+        os.replace(temporary_path, path)
+
+# Report of the script running in this process, which all the modules add their stages and counters to
+report = RunReport(None)
+
+def start_run(script):
+    global report
+    report = RunReport(script)
+    return report
+
+def stage(name):
+    return report.stage(name)
+
+def count(name, amount=1):
+    report.count(name, amount)
+
+def save_report(directory):
+    report.save(directory)
+
+# Levels of the trace, each also including the messages of the levels before it
+TRACE_OFF = 0
+TRACE_DECISIONS = 1
+TRACE_STEPS = 2
+
+# Opt-in trace of the decisions a script makes, written through a large buffer. Messages are given as a format string
+# along with its values, and are only formatted when their level is traced, so an untraced run doesn't pay for them
+class TraceLog:
+    def __init__(self, path, level, buffer_size=1 << 20):
+        self.level = level
+        self.file = None
+        if level > TRACE_OFF:
+            self.file = open(path, 'w', encoding="utf8", buffering=buffer_size)
+
+    def write(self, level, message, *values):
+        if level <= self.level:
+            self.file.write(message.format(*values) if values else message)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,44 @@
+import numpy as np
+
+# Operations on intervals of samples, kept as (N, 2) int64 arrays of [start, end) rows sorted by their start.
+# Every operation works on whole arrays at once, so hundreds of thousands of intervals take no Python loops
+
+def as_intervals(intervals):
+    return np.asarray(intervals, dtype=np.int64).reshape((-1, 2))
+
+def get_lengths(intervals):
+    return intervals[:, 1] - intervals[:, 0]
+
+# Finds the gaps between the non-overlapping intervals, from 0 up to the given length. Gaps before the first
+# and after the last interval are always included, even when they are empty
+def complement(intervals, length):
+    edges = np.concatenate(([0], intervals.reshape(-1), [length]))
+    return edges.reshape((-1, 2))
+
+# Keeps the intervals lasting at least the minimum, in seconds if the sample rate is given or in samples otherwise
+def filter_length(intervals, minimum, sr=1):
+    return intervals[get_lengths(intervals) / sr >= minimum]
+
+# Widens every interval by the given amount of samples on both sides, clipped to the range from 0 to the given length.
+# Widened intervals may overlap each other
+def pad(intervals, before, after, length):
+    padded = intervals + np.array([-before, after], dtype=np.int64)
+    return np.clip(padded, 0, length)
+
+# Maps intervals of samples at one sample rate to the nearest samples at another, clipped to the given length.
+# Integer arithmetic keeps the mapping exact however long the recording is
+def rescale(intervals, from_rate, to_rate, length):
+    if from_rate == to_rate:
+        return intervals
+    rescaled = (intervals * to_rate + from_rate // 2) // from_rate
+    return np.clip(rescaled, 0, length)
+
+# Joins the intervals that overlap, touch or are less than the given gap apart into single intervals
+def merge(intervals, gap=0):
+    if len(intervals) == 0:
+        return intervals
+    ends = np.maximum.accumulate(intervals[:, 1])
+    starts_new = np.concatenate(([True], intervals[1:, 0] - ends[:-1] >= max(gap, 1)))
+    first = np.flatnonzero(starts_new)
+    last = np.concatenate((first[1:], [len(intervals)])) - 1
+    return np.stack((intervals[first, 0], ends[last]), axis=1)
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import multiprocessing
+
+import AudioCutter
+import Transcriber
+import ClipMaker
+from TranscriptionCache import TranscriptionCache
+from ClipExport import ClipExporter
+from AudioCache import resolve_sample_rate
+import Instrumentation
+
+# Gets the path relative to either script or .exe location
+def get_dir():
+    if getattr(sys, 'frozen', False):
+        dir = os.path.dirname(sys.executable)
+    else:
+        dir = os.path.dirname(os.path.abspath(__file__))
+    return dir
+
+# Marks the end of the items put into a queue
+END = None
+
+# Takes the items from the queue until the end is reached. Errors raised by the stage filling the queue
+# are passed through it, and raised again here
+def get_queued(item_queue):
+    while True:
+        item = item_queue.get()
+        if item is END:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+# Runs the given stage in its own thread, putting the end marker or the error it stopped on into the output queue
+def start_stage(output_queue, stage, *stage_args):
+    def run():
+        try:
+            stage(*stage_args)
+            output_queue.put(END)
+        except BaseException as error:
+            output_queue.put(error)
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+# First stage, finding the non-silent segments and handing their audio over to transcription, already
+# resampled for the model. Their timestamps are saved for ClipMaker reruns, while the segments are only saved in debug mode
+def cut_segments(segment_queue, args, directory, session):
+    (y, sr, segments, timestamps) = AudioCutter.find_segments(args, directory)
+    # The decoded audio is only of use to the matching when the clips are cut at the same rate
+    session["audio"] = y if sr == resolve_sample_rate(args.audio, args.sample_rate) else None
+    session["timestamps"] = [[int(start), int(end)] for start, end in timestamps]
+    print(f"Found {len(segments)} segments")
+    AudioCutter.write_timestamps(directory, timestamps)
+
+    exporter = None
+    if args.debug:
+        segment_directory = os.path.join(directory, "Segments")
+        AudioCutter.create_folder(segment_directory)
+        exporter = ClipExporter(segment_directory, args.export_format, args.export_workers, sr)
+
+    try:
+        for i, segment in AudioCutter.get_segment_audio(y, args, sr, segments):
+            if exporter is not None:
+                exporter.write(AudioCutter.get_segment_filename(i), segment)
+            segment_queue.put((i, Transcriber.prepare_segment(segment, sr)))
+    finally:
+        if exporter is not None:
+            exporter.close()
+
+# Last stage, collecting the transcriptions as they arrive and normalizing them in the order of the segments.
+# The matchers take the whole transcript, so the matching itself starts once the last segment is in.
+# The transcript is saved the same way as by Transcriber, so ClipMaker can be rerun on its own
+def match_segments(result_queue, args, directory, session):
+    transcript = []
+    pending = {}
+    with open(os.path.join(directory, "Transcript.txt"), 'w', encoding="utf-8") as transcript_file:
+        for i, transcribed_text in get_queued(result_queue):
+            pending[i] = transcribed_text
+            while len(transcript) in pending:
+                transcribed_text = pending.pop(len(transcript))
+                transcript_file.write(transcribed_text + '\n')
+                with Instrumentation.stage("normalize"):
+                    transcript.append(ClipMaker.normalize_string(transcribed_text.strip()))
+
+    # With seek extraction, the clips are read from the file even if the cutter still holds the decoded audio
+    y = session["audio"] if args.extraction == "memory" else None
+    ClipMaker.make_clips(args, directory, transcript, session["timestamps"], y)
+
+def main(args):
+    Instrumentation.start_run("Pipeline")
+    directory = args.workspace or get_dir()
+    session = {}
+
+    # Worker processes are started before the other stages, so they aren't forked while those are running
+    engine = Transcriber.get_engine(args, args.transcription_workers)
+    engine.start()
+
+    segment_queue = queue.Queue(maxsize=args.queue_size)
+    result_queue = queue.Queue(maxsize=args.queue_size)
+    match_queue = queue.Queue()
+    start_stage(segment_queue, cut_segments, segment_queue, args, directory, session)
+    start_stage(match_queue, match_segments, result_queue, args, directory, session)
+
+    # Transcriptions are reported as they arrive, with the amount of segments known once the first one is cut
+    meter = Transcriber.ThroughputMeter(args.throughput_window)
+    transcribed = 0
+    from_cache = 0
+    def add_text(i, transcribed_text, from_model):
+        nonlocal transcribed, from_cache
+        transcribed += 1
+        progress = ""
+        if not from_model:
+            from_cache += 1
+        else:
+            meter.add()
+            progress = f" ({meter.rate():.2f} segments/s, ETA {meter.eta(len(session['timestamps']) - transcribed)})"
+        print(f"Segment {i + 1:04d}/{len(session['timestamps']):04d}: \"{transcribed_text}\"{progress}")
+        result_queue.put((i, transcribed_text))
+
+    cache = TranscriptionCache(directory, args.transcription_cache_size) if args.transcription_cache else None
+    start_time = time.perf_counter()
+    try:
+        with Instrumentation.stage("transcribe"):
+            Transcriber.transcribe_segments(get_queued(segment_queue), engine, cache, add_text)
+        result_queue.put(END)
+    except BaseException as error:
+        result_queue.put(error)
+        raise
+    finally:
+        engine.close()
+        if cache is not None:
+            cache.save()
+
+    elapsed = time.perf_counter() - start_time
+    # Only the segments transcribed by the model count towards the throughput, not the ones found in the cache
+    from_model = transcribed - from_cache
+    print(f"Cut and transcribed {from_model} segments in {elapsed:.1f}s, {from_model / max(elapsed, 1e-9):.2f} segments/s, "
+          f"{from_cache} taken from the cache")
+    if cache is not None:
+        print(cache.stats())
+
+    # Waits for the clips to be saved, raising any error the matching stopped on
+    for _ in get_queued(match_queue):
+        pass
+    Instrumentation.save_report(directory)
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    # All the arguments of AudioCutter, along with the options of the later stages
+    parser = AudioCutter.get_argument_parser()
+    parser.description = "Script to cut up, transcribe and match the audio file in a single run"
+    parser.add_argument("--transcription_workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--transcription_cache", type=int, default=1)
+    parser.add_argument("--transcription_cache_size", type=int, default=100000)
+    parser.add_argument("--throughput_window", type=int, default=20)
+    parser.add_argument("--service", type=int, default=1)
+    parser.add_argument("--service_port", type=int, default=Transcriber.SERVICE_PORT)
+    parser.add_argument("--service_priority", type=int, default=0)
+    parser.add_argument("--use_similarity_matrix", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--queue_size", type=int, default=16)
+    parser.add_argument("--debug", type=int, default=0)
+    parser.add_argument("--trace", type=int, choices=[0, 1, 2], default=0)
+    # The decoded audio and the frame loudness are only saved in debug mode, unless asked for
+    parser.set_defaults(audio_cache=None, envelope=None)
+    args = parser.parse_args()
+    args.mode = "clips"
+    if args.audio_cache is None:
+        args.audio_cache = args.debug
+    if args.envelope is None:
+        args.envelope = args.debug
+
+    # Saved the same way as by AudioCutter, so ClipMaker can be rerun on its own afterwards
+    directory = args.workspace or get_dir()
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "args.json"), 'w') as file:
+        json.dump(vars(args), file)
+
+    main(args)
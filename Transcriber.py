@@ -1,6 +1,21 @@
-import whisper
+import numpy as np
+import soundfile as sf
+import soxr
 import os
 import sys
+import time
+import json
+import queue
+import base64
+import argparse
+import urllib.request
+import urllib.error
+import multiprocessing
+from collections import deque
+
+from AudioCache import get_file_key
+from TranscriptionCache import TranscriptionCache, get_transcription_key
+import Instrumentation
 
 # Gets the path relative to either script or .exe location
 def get_dir():
@@ -10,29 +25,368 @@ def get_dir():
         dir = os.path.dirname(os.path.abspath(__file__))
     return dir
 
-# Definitions for filepaths used in the script
-directory = get_dir()
-segment_directory = os.path.join(directory, "Segments")
-
 # Path to the used whisper model
-MODEL_PATH = os.path.join(directory, "small.en.pt")
-
-# Loading NLP model
-model = whisper.load_model(MODEL_PATH)
-
-# Variables for transcription loop
-transcript = []
-i = 0
-files = os.listdir(segment_directory)
-
-for i, file in enumerate(files):
-    transcribed_text = model.transcribe(os.path.join(segment_directory, file), fp16=False)
-    # Transcript always adds " " at the start of text, it is removed here
-    transcribed_text = transcribed_text['text'][1:]
-    print(f"Segment {i + 1:04d}/{len(files):04d}: \"{transcribed_text}\"")
-    transcript.append(transcribed_text)
-
-# Saving transcribed sentences to file
-with open(os.path.join(directory, "Transcript.txt"), 'w', encoding="utf-8") as file:
-    for line in transcript:
-        file.write(line + '\n')
\ No newline at end of file
+MODEL_PATH = os.path.join(get_dir(), "small.en.pt")
+
+# Port of the transcription service on this machine
+SERVICE_PORT = 8765
+
+# Sample rate whisper works at and the most samples it decodes in one window, the same as whisper.audio.SAMPLE_RATE
+# and whisper.audio.N_SAMPLES. Whisper and torch take seconds to import, so they are only imported once the model is needed,
+# which runs handing their segments over to the transcription service never do
+SAMPLE_RATE = 16000
+N_SAMPLES = 30 * SAMPLE_RATE
+
+# Whisper model, loaded once into every process that transcribes
+model = None
+
+def init_worker(model_path, threads):
+    global model
+    import torch
+    import whisper
+    if threads > 0:
+        torch.set_num_threads(threads)
+    model = whisper.load_model(model_path)
+
+# Reads an audio segment as mono samples at the sample rate whisper works with, so that the model can be
+# given the samples directly instead of decoding the file again through ffmpeg
+def load_segment(path):
+    audio, sr = sf.read(path, dtype='float32', always_2d=True)
+    return prepare_segment(np.mean(audio, axis=1), sr)
+
+def prepare_segment(audio, sr):
+    if sr != SAMPLE_RATE:
+        audio = soxr.resample(audio, sr, SAMPLE_RATE, quality='soxr_hq')
+    return np.ascontiguousarray(audio, dtype=np.float32)
+
+# Identifies the model by its contents alone, so it is recognized even after being copied elsewhere
+def get_model_key(model_path):
+    model_key = get_file_key(model_path)
+    del model_key["mtime"]
+    return model_key
+
+# Whether the clip is decoded in a batch, rather than transcribed by itself
+def is_batched(audio, batch_size):
+    return batch_size > 1 and len(audio) <= N_SAMPLES
+
+# Transcribes a batch of (index, audio) items. Batches of clips that fit into whisper's 30 second window
+# are decoded together in a single pass, while longer clips are transcribed by themselves
+def transcribe_batch(batch, batch_size):
+    import torch
+    import whisper
+    if all(is_batched(audio, batch_size) for _, audio in batch):
+        mels = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels) for _, audio in batch])
+        results = whisper.decode(model, mels.to(model.device), whisper.DecodingOptions(fp16=False, without_timestamps=True))
+        return [(index, result.text) for (index, _), result in zip(batch, results)]
+
+    transcribed = []
+    for index, audio in batch:
+        transcribed_text = model.transcribe(audio, fp16=False)
+        # Transcript always adds " " at the start of text, it is removed here
+        transcribed.append((index, transcribed_text['text'][1:]))
+    return transcribed
+
+# Groups the items into batches of up to batch_size clips that are short enough to be decoded together.
+# Longer clips are put into batches of their own
+def get_batches(items, batch_size):
+    batch = []
+    for index, audio in items:
+        if not is_batched(audio, batch_size):
+            yield [(index, audio)]
+            continue
+        batch.append((index, audio))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Transcription engine running the whisper model either in this process or over a pool of worker processes,
+# each with its own copy of the model and its own share of torch threads
+class TranscriptionEngine:
+    def __init__(self, model_path, workers=1, threads=0, batch_size=1):
+        self.model_path = model_path
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        # Without a set amount, the cores are split evenly between the workers
+        self.threads = threads if threads > 0 or self.workers == 1 else max(1, os.cpu_count() // self.workers)
+        self.pool = None
+
+    # Transcribes the (index, audio) items, yielding (index, text) pairs as soon as they are done.
+    # Only a few batches per worker are handed out at a time, so the items are read as the workers need them.
+    # The model is only loaded once the first batch arrives
+    def transcribe(self, items):
+        if self.workers == 1:
+            for batch in get_batches(items, self.batch_size):
+                if model is None:
+                    init_worker(self.model_path, self.threads)
+                yield from transcribe_batch(batch, self.batch_size)
+            return
+
+        results = queue.Queue()
+        in_flight = 0
+        for batch in get_batches(items, self.batch_size):
+            self.start()
+            self.pool.apply_async(transcribe_batch, (batch, self.batch_size), callback=results.put, error_callback=results.put)
+            in_flight += 1
+            while in_flight >= 2 * self.workers:
+                yield from self.get_result(results)
+                in_flight -= 1
+        while in_flight > 0:
+            yield from self.get_result(results)
+            in_flight -= 1
+
+    # Starts the worker processes, if they aren't running yet
+    def start(self):
+        if self.workers > 1 and self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers, initializer=init_worker, initargs=(self.model_path, self.threads))
+
+    def get_result(self, results):
+        result = results.get()
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def get_model_key(self):
+        return get_model_key(self.model_path)
+
+# Transcription engine handing the segments over to the transcription service running on this machine, which keeps
+# the model loaded between runs. Segments are sent a few at a time, so jobs of other runs with a higher priority
+# don't wait for all of them
+class ServiceEngine:
+    def __init__(self, port, priority=0, chunk_size=16):
+        self.url = f"http://127.0.0.1:{port}"
+        self.priority = priority
+        self.chunk_size = chunk_size
+        self.health = None
+        self.batch_size = None
+
+    # Checks that the service is running, returning False if it isn't
+    def connect(self):
+        try:
+            with urllib.request.urlopen(self.url + "/health", timeout=2) as response:
+                self.health = json.load(response)
+        except (urllib.error.URLError, OSError, ValueError):
+            return False
+        self.batch_size = self.health["batch_size"]
+        return True
+
+    def transcribe(self, items):
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                yield from self.transcribe_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from self.transcribe_chunk(chunk)
+
+    def transcribe_chunk(self, chunk):
+        request = {
+            "priority": self.priority,
+            "segments": [base64.b64encode(np.ascontiguousarray(audio, dtype=np.float32).tobytes()).decode("ascii") for _, audio in chunk],
+        }
+        request = urllib.request.Request(self.url + "/transcribe", data=json.dumps(request).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                texts = json.load(response)["texts"]
+        except urllib.error.HTTPError as error:
+            raise RuntimeError(f"Transcription service failed: {error.read().decode('utf-8', 'replace')}") from None
+        return [(index, text) for (index, _), text in zip(chunk, texts)]
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    # Key of the model loaded by the service, so transcriptions are cached the same way as with the model loaded here
+    def get_model_key(self):
+        return self.health["model_key"]
+
+# Transcribes with the service when one is running on this machine, and otherwise loads the model into this run
+def get_engine(args, workers):
+    if args.service:
+        engine = ServiceEngine(args.service_port, args.service_priority)
+        if engine.connect():
+            print(f"Transcribing with the service on port {args.service_port}")
+            return engine
+    return TranscriptionEngine(MODEL_PATH, workers, args.threads, args.batch_size)
+
+# Append-only record of the transcribed segments, written as soon as every segment is done so that a run
+# which stops half way can be resumed. Every entry is tied to the size and modification time of its segment
+# file, so entries left from segments that AudioCutter has since replaced are ignored, and to the model and
+# batch size, so entries transcribed by another model or with other decoding options are ignored as well
+class TranscriptJournal:
+    def __init__(self, directory, engine):
+        self.path = os.path.join(directory, "TranscriptJournal.jsonl")
+        self.key = {"model": engine.get_model_key(), "batch_size": engine.batch_size}
+        self.file = None
+
+    # Returns the transcriptions of the journaled segments that are still the same, by their index.
+    # The journal is then rewritten with only these entries, or emptied when not resuming, before new ones are appended to it
+    def load(self, segment_directory, files, resume):
+        stats = [self.get_stat(segment_directory, file) for file in files]
+        texts = {}
+        if resume and os.path.exists(self.path):
+            with open(self.path, 'r', encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Last line of a run that stopped while writing it
+                        continue
+                    i = entry["segment"]
+                    if i < len(files) and entry["file"] == files[i] and entry["stat"] == stats[i] and entry.get("key") == self.key:
+                        texts[i] = entry["text"]
+
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w', encoding="utf-8") as file:
+            for i in sorted(texts):
+                file.write(json.dumps({"segment": i, "file": files[i], "stat": stats[i], "key": self.key, "text": texts[i]}) + '\n')
+        os.replace(temporary_path, self.path)
+
+        self.files = files
+        self.stats = stats
+        self.file = open(self.path, 'a', encoding="utf-8")
+        return texts
+
+    def get_stat(self, segment_directory, file):
+        stat = os.stat(os.path.join(segment_directory, file))
+        return [stat.st_size, stat.st_mtime]
+
+    # Entries are flushed to disk right away, so they survive the process being killed
+    def add(self, i, text):
+        self.file.write(json.dumps({"segment": i, "file": self.files[i], "stat": self.stats[i], "key": self.key, "text": text}) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# Measures the throughput over the last few transcribed segments, so the estimate follows changes in speed
+# instead of averaging over the whole run
+class ThroughputMeter:
+    def __init__(self, window):
+        self.times = deque([time.perf_counter()], maxlen=window + 1)
+
+    def add(self):
+        self.times.append(time.perf_counter())
+
+    def rate(self):
+        elapsed = self.times[-1] - self.times[0]
+        return (len(self.times) - 1) / elapsed if elapsed > 0 else 0
+
+    def eta(self, remaining):
+        rate = self.rate()
+        if rate == 0:
+            return "--:--:--"
+        seconds = int(remaining / rate)
+        return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+# Transcribes the (index, audio) segments, taking the ones transcribed by a former run with the same model and options
+# from the cache and only handing the rest of them to the model. Every transcription is passed on to add_text along
+# with whether it came from the model
+def transcribe_segments(items, engine, cache, add_text):
+    model_key = engine.get_model_key() if cache is not None else None
+    keys = {}
+
+    def get_uncached_items():
+        for i, audio in items:
+            if cache is not None:
+                options = {"fp16": False, "batched": is_batched(audio, engine.batch_size)}
+                keys[i] = get_transcription_key(audio, model_key, options)
+                transcribed_text = cache.get(keys[i])
+                if transcribed_text is not None:
+                    Instrumentation.count("transcription_cache_hits")
+                    add_text(i, transcribed_text, False)
+                    continue
+            yield (i, audio)
+
+    for i, transcribed_text in engine.transcribe(get_uncached_items()):
+        if cache is not None:
+            cache.put(keys.pop(i), transcribed_text)
+        Instrumentation.count("segments_transcribed")
+        add_text(i, transcribed_text, True)
+
+def main(args):
+    Instrumentation.start_run("Transcriber")
+
+    # Definitions for filepaths used in the script
+    directory = args.workspace or get_dir()
+    segment_directory = os.path.join(directory, "Segments")
+
+    # Segments are named by their index, so sorting the names keeps them in the order they were cut
+    files = sorted(os.listdir(segment_directory))
+
+    # Segments already transcribed by a former run with the same model that didn't finish are skipped
+    engine = get_engine(args, args.workers)
+    journal = TranscriptJournal(directory, engine)
+    transcript = journal.load(segment_directory, files, args.resume)
+    if transcript:
+        print(f"Resuming with {len(transcript)}/{len(files)} segments already transcribed")
+
+    meter = ThroughputMeter(args.throughput_window)
+    # Only the segments transcribed by the model count towards the throughput, not the ones found in the cache
+    counts = {"model": 0, "cache": 0}
+    def add_text(i, transcribed_text, transcribed):
+        transcript[i] = transcribed_text
+        journal.add(i, transcribed_text)
+        counts["model" if transcribed else "cache"] += 1
+        progress = ""
+        if transcribed:
+            meter.add()
+            progress = f" ({meter.rate():.2f} segments/s, ETA {meter.eta(len(files) - len(transcript))})"
+        print(f"Segment {i + 1:04d}/{len(files):04d}: \"{transcribed_text}\"{progress}")
+
+    cache = TranscriptionCache(directory, args.transcription_cache_size) if args.transcription_cache else None
+    items = ((i, load_segment(os.path.join(segment_directory, file))) for i, file in enumerate(files) if i not in transcript)
+
+    start_time = time.perf_counter()
+    try:
+        with Instrumentation.stage("transcribe"):
+            transcribe_segments(items, engine, cache, add_text)
+    finally:
+        engine.close()
+        journal.close()
+        if cache is not None:
+            cache.save()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Transcribed {counts['model']} segments in {elapsed:.1f}s, {counts['model'] / max(elapsed, 1e-9):.2f} segments/s, "
+          f"{counts['cache']} taken from the cache")
+    if cache is not None:
+        print(cache.stats())
+
+    # Saving transcribed sentences to file, as collected in the journal
+    with open(os.path.join(directory, "Transcript.txt"), 'w', encoding="utf-8") as file:
+        for i in range(len(files)):
+            file.write(transcript[i] + '\n')
+    Instrumentation.save_report(directory)
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description="Script to transcribe the cut up audio segments")
+    parser.add_argument("--workspace", default=None)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--transcription_cache", type=int, default=1)
+    parser.add_argument("--transcription_cache_size", type=int, default=100000)
+    parser.add_argument("--resume", type=int, default=1)
+    parser.add_argument("--throughput_window", type=int, default=20)
+    parser.add_argument("--service", type=int, default=1)
+    parser.add_argument("--service_port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--service_priority", type=int, default=0)
+
+    main(parser.parse_args())
@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+# Identifies the transcription of a segment by its samples, the model file and the options it was decoded with,
+# so a segment that comes out the same from a new run of AudioCutter is recognized regardless of its index
+def get_transcription_key(audio, model_key, options):
+    key_hash = hashlib.sha1(audio.tobytes())
+    key_hash.update(json.dumps([model_key, options], sort_keys=True).encode())
+    return key_hash.hexdigest()
+
+# Transcriptions of former runs, kept on disk in least recently used order. When more than max_size
+# transcriptions are stored, the ones that were used the longest time ago are evicted
+class TranscriptionCache:
+    def __init__(self, directory, max_size):
+        self.path = os.path.join(directory, "TranscriptionCache.json")
+        self.max_size = max_size
+        self.texts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding="utf-8") as file:
+                self.texts = OrderedDict(json.load(file))
+            self.evict()
+
+    # Returns the cached transcription, or None if the segment wasn't transcribed before
+    def get(self, key):
+        text = self.texts.get(key)
+        if text is None:
+            self.misses += 1
+            return None
+        self.texts.move_to_end(key)
+        self.hits += 1
+        return text
+
+    def put(self, key, text):
+        self.texts[key] = text
+        self.texts.move_to_end(key)
+        self.evict()
+
+    def evict(self):
+        while len(self.texts) > self.max_size:
+            self.texts.popitem(last=False)
+            self.evictions += 1
+
+    # The cache is written to a temporary file first, so a run that stops while saving never corrupts it
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w', encoding="utf-8") as file:
+            json.dump(list(self.texts.items()), file)
+        os.replace(temporary_path, self.path)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f"Transcription cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hit rate), " \
+               f"{self.evictions} evictions, {len(self.texts)} stored"
@@ -0,0 +1,172 @@
+import os
+import json
+import time
+import base64
+import argparse
+import threading
+import itertools
+import multiprocessing
+import numpy as np
+from queue import PriorityQueue
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import Transcriber
+
+# Job handed over to the model by one of the clients, holding the (position, audio) items to transcribe.
+# The client waits on it until the texts, in the order of the items, or the error the transcription stopped on are set
+class TranscriptionJob:
+    def __init__(self, items, priority):
+        self.items = items
+        self.priority = priority
+        self.queued = time.perf_counter()
+        self.done = threading.Event()
+        self.texts = None
+        self.error = None
+
+# Keeps the whisper model loaded and transcribes the jobs of all clients one after another, by their priority,
+# higher first, and in the order they arrived within the same priority
+class TranscriptionService:
+    def __init__(self, engine):
+        self.engine = engine
+        self.model_key = Transcriber.get_model_key(engine.model_path)
+        self.jobs = PriorityQueue()
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stats = {"jobs": 0, "segments": 0, "errors": 0, "busy_seconds": 0, "wait_seconds": 0, "clients": 0, "active_clients": 0}
+
+    def submit(self, items, priority):
+        job = TranscriptionJob(items, priority)
+        self.jobs.put((-priority, next(self.order), job))
+        return job
+
+    # Runs the jobs on the model, for as long as the service is up
+    def run(self):
+        while True:
+            (_, _, job) = self.jobs.get()
+            start_time = time.perf_counter()
+            try:
+                texts = dict(self.engine.transcribe(job.items))
+                job.texts = [texts[position] for position, _ in job.items]
+            except Exception as error:
+                job.error = error
+            busy = time.perf_counter() - start_time
+            with self.lock:
+                self.stats["jobs"] += 1
+                self.stats["segments"] += len(job.items)
+                self.stats["errors"] += job.error is not None
+                self.stats["busy_seconds"] += busy
+                self.stats["wait_seconds"] += start_time - job.queued
+            job.done.set()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["queued_jobs"] = self.jobs.qsize()
+        stats["uptime_seconds"] = time.time() - self.started
+        stats["segments_per_second"] = stats["segments"] / max(stats["busy_seconds"], 1e-9)
+        return stats
+
+    # Describes the model, so the clients can key their transcription caches the same way as with the model loaded themselves
+    def get_health(self):
+        return {
+            "status": "ok",
+            "model_key": self.model_key,
+            "batch_size": self.engine.batch_size,
+            "sample_rate": Transcriber.SAMPLE_RATE,
+        }
+
+# Reads the segments of a job, either given as base64 encoded float32 samples at whisper's sample rate,
+# or as the files of a segment folder
+def read_job_items(request):
+    if "segments" in request:
+        return [(position, np.frombuffer(base64.b64decode(segment), dtype=np.float32))
+                for position, segment in enumerate(request["segments"])]
+    directory = request["directory"]
+    files = request.get("files") or sorted(os.listdir(directory))
+    return [(position, Transcriber.load_segment(os.path.join(directory, file))) for position, file in enumerate(files)]
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def send_json(self, status, response):
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, self.service.get_health())
+        elif self.path == "/stats":
+            self.send_json(200, self.service.get_stats())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    # Transcribes a job of {"segments": [...]} or {"directory": ..., "files": [...]}, with an optional "priority",
+    # answering with the "texts" in the order of the segments once the job is done
+    def do_POST(self):
+        if self.path != "/transcribe":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        with self.service.lock:
+            self.service.stats["clients"] += 1
+            self.service.stats["active_clients"] += 1
+        try:
+            try:
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                items = read_job_items(request)
+            except (ValueError, KeyError, TypeError, OSError) as error:
+                self.send_json(400, {"error": repr(error)})
+                return
+            job = self.service.submit(items, int(request.get("priority", 0)))
+            job.done.wait()
+            if job.error is not None:
+                self.send_json(500, {"error": repr(job.error)})
+            else:
+                self.send_json(200, {"texts": job.texts})
+        finally:
+            with self.service.lock:
+                self.service.stats["active_clients"] -= 1
+
+    # Every request is printed only in verbose mode
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+def main(args):
+    engine = Transcriber.TranscriptionEngine(Transcriber.MODEL_PATH, args.workers, args.threads, args.batch_size)
+    engine.start()
+    # The model is loaded before the first client arrives, so no job waits for it
+    if engine.workers == 1:
+        Transcriber.init_worker(engine.model_path, engine.threads)
+
+    ServiceHandler.service = TranscriptionService(engine)
+    threading.Thread(target=ServiceHandler.service.run, daemon=True).start()
+
+    # Only clients on this machine can reach the service
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), ServiceHandler)
+    server.daemon_threads = True
+    server.verbose = args.verbose
+    print(f"Transcription service listening on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.close()
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+
+    parser = argparse.ArgumentParser(description="Service keeping the whisper model loaded for the transcriptions of all runs on this machine")
+    parser.add_argument("--port", type=int, default=Transcriber.SERVICE_PORT)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--verbose", type=int, default=0)
+
+    main(parser.parse_args())
@@ -0,0 +1,49 @@
+import random
+
+from ClipMaker import get_similarity, is_string_substring
+
+# Generates all possible ways that words could be broken down to sentences, as the substring check did before
+# find_best_substring, which is kept as the reference it has to agree with
+def generate_sentences(words):
+    sentences = []
+    for i in range(len(words)):
+        for j in range(i + 1, len(words)  + 1):
+            sentence = words[i]
+            for k in range(i + 1, j):
+                sentence += " " + words[k]
+            sentences.append(sentence)
+    return sentences
+
+def is_string_substring_reference(full_string, possible_substring, threshold):
+    if len(possible_substring) == 0 or len(possible_substring) / len(full_string) > 0.99:
+        return False
+    for substring in generate_sentences(full_string.split()):
+        if get_similarity(substring, possible_substring) >= threshold:
+            return True
+    return False
+
+# Transcript lines are taken from the script line itself, with words dropped and letters changed, so that most of them
+# land close to the thresholds, along with unrelated lines
+def generate_case(generator, vocabulary):
+    words = [generator.choice(vocabulary) for _ in range(generator.randint(1, 14))]
+    full_string = " ".join(words)
+    if generator.random() < 0.2:
+        possible_substring = " ".join(generator.choice(vocabulary) for _ in range(generator.randint(1, 6)))
+    else:
+        start = generator.randrange(len(words))
+        span = words[start:start + generator.randint(1, len(words) - start)]
+        characters = list(" ".join(span))
+        for _ in range(generator.randint(0, 3)):
+            characters[generator.randrange(len(characters))] = generator.choice("abcdefghij ")
+        possible_substring = "".join(characters).strip()
+    return (full_string, possible_substring)
+
+def test_is_string_substring_matches_reference():
+    generator = random.Random(0)
+    vocabulary = ["a", "an", "the", "cat", "sat", "on", "mat", "dog", "barked", "loudly", "at", "night", "we", "go", "home"]
+    for _ in range(3000):
+        (full_string, possible_substring) = generate_case(generator, vocabulary)
+        for threshold in [0.5, 0.7, 0.75, 0.8, 0.9, 1.0]:
+            expected = is_string_substring_reference(full_string, possible_substring, threshold)
+            assert is_string_substring(full_string, possible_substring, threshold) == expected, \
+                (full_string, possible_substring, threshold)